@@ -4,6 +4,14 @@ The Easyleed package is divided into several subpackages:
 - base: Core functionality (fitting procedures, Tracker class, etc.)
 - kalman: Implementation of Kalman filter classes
 - io: Input/Output functionality (reading FITS and IMG files)
+- batch: Headless tracking and command line interface
+- parallel: Tracking in several processes
+- curves: Aggregation of I(E)-curves
+- timing: Timers for the processing stages
+- diagnostics: Counted events of the tracking
+- detection: Automatic detection of spots
+- lattice: Common movement of all spots
+- gui: Graphical user interface (needs PyQt4)
 
 .. automodule:: easyleed.base
     :members:
@@ -14,6 +22,27 @@ The Easyleed package is divided into several subpackages:
 .. automodule:: easyleed.io
     :members:
 
+.. automodule:: easyleed.batch
+    :members:
+
+.. automodule:: easyleed.parallel
+    :members:
+
+.. automodule:: easyleed.curves
+    :members:
+
+.. automodule:: easyleed.timing
+    :members:
+
+.. automodule:: easyleed.diagnostics
+    :members:
+
+.. automodule:: easyleed.detection
+    :members:
+
+.. automodule:: easyleed.lattice
+    :members:
+
 """
 
 __version__ = "1.0"
@@ -22,9 +51,20 @@ __author__ = "Andreas Mayer, Hanna Salopaasi"
 # import packages
 # order of loading is important and should not be changed
 import default_config as config
+import timing
+import diagnostics
+import detection
+import lattice
 import kalman
 import io
 import base
+import batch
+import parallel
+import curves
 import test
 import my_flatten
-import gui
+try:
+    import gui
+except ImportError:
+    # PyQt4 or matplotlib missing, only headless functionality available
+    base.logger.warning("The GUI could not be loaded, only headless processing available.")
@@ -9,11 +9,58 @@ Base class providing common functionality for analyzing Leed patterns.
 import logging
 logger = logging.getLogger("leedbase")
 
+import collections
+
 import numpy as np
 from scipy import optimize
 
 from . import config
 from . import kalman
+from .lattice import LatticeModel
+from .timing import timers
+from .diagnostics import diagnostics
+
+# fit status of a spot at one energy (see ResultStore.status), all but
+# STATUS_FOUND mean that the Kalman prediction was used
+STATUS_FOUND = 0            # position measured in the image
+STATUS_PREDICTED = 1        # no valid measurement (other reason)
+STATUS_GATED = 2            # fitted position outside the validation gate
+STATUS_FIT_FAILED = 3       # fit did not converge
+STATUS_LOW_RSQ = 4          # R^2 of the fit below config.Tracking_minRsq
+STATUS_OUTSIDE_IMAGE = 5    # window completely outside the image
+# flag added to the status if the window was clipped at the image border
+STATUS_CLIPPED = 0x80
+# flag added to the status if a spot without measurement was placed by the
+# lattice model (see TrackerBank)
+STATUS_LATTICE = 0x40
+
+""" Names of the status values (without the flags STATUS_CLIPPED and STATUS_LATTICE). """
+STATUS_NAMES = {STATUS_FOUND: "found", STATUS_PREDICTED: "predicted",
+                STATUS_GATED: "gated", STATUS_FIT_FAILED: "fit_failed",
+                STATUS_LOW_RSQ: "low_rsq", STATUS_OUTSIDE_IMAGE: "outside_image"}
+
+""" Status of a spot whose guess failed, by the diagnostics event. """
+EVENT_STATUS = dict((name, status) for status, name in STATUS_NAMES.iteritems()
+                    if name in ("fit_failed", "low_rsq", "outside_image"))
+
+def report_failure(event, outcome=None):
+    """ Records the failure event of a guess (see diagnostics.EVENTS) and
+    stores the STATUS_* value of the spot as "status" in the dict outcome. """
+    diagnostics.event(event)
+    if outcome is not None:
+        outcome["status"] = EVENT_STATUS[event]
+
+def status_counts(status):
+    """ Returns the number of every status (by name, see STATUS_NAMES),
+    of clipped windows ("clipped_window") and of spots placed by the lattice
+    model ("lattice") in an array of status values. """
+    status = np.asarray(status).astype(np.uint8)
+    outcome = status & ~np.uint8(STATUS_CLIPPED | STATUS_LATTICE)
+    counts = dict((name, int(np.count_nonzero(outcome == value)))
+                  for value, name in STATUS_NAMES.iteritems())
+    counts["clipped_window"] = int(np.count_nonzero(status & STATUS_CLIPPED))
+    counts["lattice"] = int(np.count_nonzero(status & STATUS_LATTICE))
+    return counts
 
 class SpotModel:
     """ Data model for a Spot that stores all the information in various lists.
@@ -33,6 +80,90 @@ class SpotModel:
         self.energy.append(energy)
         self.radius.append(radius)
 
+class ResultStore(object):
+    """ Stores the results of all spots in preallocated arrays.
+
+    The attributes x, y, intensity, radius and status are arrays of shape
+    (n_spots, n_energies) holding only the processed energies (the
+    underlying buffers grow if more energies than expected are added).
+    """
+
+    def __init__(self, n_spots, n_energies=0):
+        """
+        n_spots: number of spots
+        n_energies: expected number of energies (e.g. from the loader)
+        """
+        self.n_spots = n_spots
+        self.count = 0
+        self._allocate(max(n_energies, 1))
+
+    def _allocate(self, capacity):
+        old = getattr(self, "_buffers", None)
+        self._buffers = {"energy": np.empty(capacity)}
+        for name in ("x", "y", "intensity", "radius"):
+            self._buffers[name] = np.empty((self.n_spots, capacity))
+        self._buffers["status"] = np.empty((self.n_spots, capacity), dtype=np.uint8)
+        if old is not None:
+            for name, array in old.iteritems():
+                self._buffers[name][..., :self.count] = array[..., :self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __getattr__(self, name):
+        if name in ("energy", "x", "y", "intensity", "radius", "status"):
+            return self._buffers[name][..., :self.count]
+        raise AttributeError(name)
+
+    def append(self, results, status=None):
+        """ Adds the results of one energy.
+
+        results: list of (x, y, intensity, energy, radius), one per spot
+        status: fit status of the spots (default: STATUS_FOUND)
+        """
+        if self.count == self._buffers["energy"].shape[0]:
+            self._allocate(2 * self.count)
+        results = np.asarray(results, dtype=float).reshape(self.n_spots, 5)
+        column = self.count
+        for index, name in enumerate(("x", "y", "intensity")):
+            self._buffers[name][:, column] = results[:, index]
+        self._buffers["radius"][:, column] = results[:, 4]
+        self._buffers["status"][:, column] = STATUS_FOUND if status is None else status
+        self._buffers["energy"][column] = results[0, 3] if self.n_spots else np.nan
+        self.count += 1
+
+    def get_state(self):
+        """ Returns copies of the stored arrays as a dictionary. """
+        return dict((name, getattr(self, name).copy())
+                    for name in ("energy", "x", "y", "intensity", "radius", "status"))
+
+    def set_state(self, state):
+        """ Replaces the stored results by those of get_state. """
+        count = len(state["energy"])
+        self.count = 0
+        self._allocate(max(count, self._buffers["energy"].shape[0]))
+        for name, array in state.iteritems():
+            self._buffers[name][..., :count] = array
+        self.count = count
+
+    def spot(self, index):
+        """ Returns a SpotModel-like view of the results of one spot. """
+        return SpotView(self, index)
+
+class SpotView(object):
+    """ Results of one spot in a ResultStore, with the attributes of SpotModel. """
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getattr__(self, name):
+        if name == "energy":
+            return self.store.energy
+        if name in ("x", "y", "intensity", "radius", "status"):
+            return getattr(self.store, name)[self.index]
+        raise AttributeError(name)
+
 class Tracker:
     """ Tracks spots through intensity information and velocity prediction. """
     def __init__(self, x_in, y_in, radius, energy,
@@ -41,6 +172,8 @@ class Tracker:
         self.radius = radius
         cov_input = np.diag([input_precision, input_precision, 1000, 1000])
         self.kalman = kalman.PVKalmanFilter2(x_in, y_in, cov_input, energy)
+        # fit results of the last energy (start values for the next fit)
+        self.hint = {}
         self.window_scaling = window_scaling
         if self.window_scaling:
             self.c_size = energy**0.5 * self.radius
@@ -53,20 +186,160 @@ class Tracker:
             self.radius = config.Tracking_minWindowSize
         self.kalman.predict(energy, config.Tracking_processNoise)
         x_p, y_p = self.kalman.get_position()
-        guess = guesser(npimage, x_p, y_p, self.radius, kalman = self.kalman)
+        fit = {}
+        guess = guesser(npimage, x_p, y_p, self.radius, kalman = self.kalman, hint = self.hint, fit = fit)
+        accepted = False
         if guess is not None:
             x_th, y_th, guess_cov = guess
             # spot in validation region?  (based on residual covariance)
             if self.kalman.measurement_distance((x_th, y_th), guess_cov) > config.Tracking_gamma:
-                print "no spot in validation gate"
+                diagnostics.event("gated")
             else:
                 self.kalman.update([x_th, y_th], guess_cov)
+                accepted = True
+        # only accepted fits are start values for the next energy
+        self.hint = fit if accepted else {}
         x, y = self.kalman.get_position()
-        intensity = calc_intensity(npimage, x, y, self.radius)
+        intensity = tracking_integrator().intensity(npimage, x, y, self.radius,
+                background_substraction=config.Processing_backgroundSubstractionOn)
         return x, y, intensity, energy, self.radius
 
+class TrackerBank:
+    """ Tracks a set of spots like a list of Tracker instances,
+    but with all Kalman filters in one PVKalmanFilterBank.
+
+    With a lattice model (see lattice.LatticeModel) the fit windows are
+    placed by the common movement of all spots, which is fitted to the
+    spots found at every energy, and the spots without measurement are
+    updated with their position in the fitted model.
+    """
+    def __init__(self, x_in, y_in, radius, energy,
+            input_precision=1, window_scaling=False, lattice=False):
+        """ x_in, y_in, radius: start positions and radii of the spots
+        lattice: track the spots with a lattice model """
+        self.radius = np.array(radius, dtype=float)
+        cov_input = np.diag([input_precision, input_precision, 1000, 1000])
+        self.kalman = kalman.PVKalmanFilterBank(x_in, y_in, cov_input, energy)
+        # fit results of the last energy (start values for the next fit)
+        self.hints = [{} for i in range(len(self.radius))]
+        # fit status of the spots at the last energy
+        self.status = np.zeros(len(self.radius), dtype=np.uint8)
+        self.window_scaling = window_scaling
+        if self.window_scaling:
+            self.c_size = energy**0.5 * self.radius
+        self.lattice = LatticeModel(x_in, y_in, energy) if lattice else None
+
+    def __len__(self):
+        return len(self.radius)
+
+    def get_state(self):
+        """ Returns the complete tracking state as a dictionary of arrays.
+
+        All arrays but those of the lattice model (lattice_*) have one
+        entry per spot along the first axis.
+        """
+        hints = np.array([[hint.get(name, np.nan) for name in HINT_NAMES]
+                          for hint in self.hints]).reshape(len(self), len(HINT_NAMES))
+        state = {"x": self.kalman.x.copy(), "P": self.kalman.P.copy(),
+                 "old_time": self.kalman.old_time.copy(), "radius": self.radius.copy(),
+                 "hints": hints, "status": self.status.copy()}
+        if self.window_scaling:
+            state["c_size"] = self.c_size.copy()
+        if self.lattice is not None:
+            state.update(("lattice_" + name, value)
+                         for name, value in self.lattice.get_state().iteritems())
+        return state
+
+    def set_state(self, state):
+        """ Restores a state returned by get_state. """
+        self.kalman.x[...] = state["x"]
+        self.kalman.P[...] = state["P"]
+        self.kalman.old_time[...] = state["old_time"]
+        self.radius = np.array(state["radius"], dtype=float)
+        self.hints = [{} if np.isnan(hint).any() else dict(zip(HINT_NAMES, hint))
+                      for hint in state["hints"]]
+        self.status = np.array(state["status"], dtype=np.uint8)
+        if self.window_scaling:
+            self.c_size = np.array(state["c_size"], dtype=float)
+        if self.lattice is not None:
+            self.lattice.set_state(dict((name[len("lattice_"):], value)
+                    for name, value in state.iteritems() if name.startswith("lattice_")))
+
+    def feed_image(self, image):
+        """ Returns a list of (x, y, intensity, energy, radius) for all spots. """
+        npimage, energy = image
+        if self.window_scaling:
+            self.radius = self.c_size / energy**0.5
+        self.radius = np.maximum(self.radius, config.Tracking_minWindowSize)
+        with timers("predict"):
+            self.kalman.predict(energy, config.Tracking_processNoise)
+        x_p, y_p = self.kalman.get_position()
+        if self.lattice is not None:
+            # windows placed by the common movement of all spots
+            x_p, y_p = self.lattice.predict_positions(energy)
+        z = np.column_stack((x_p, y_p))
+        cov = np.empty((len(self), 2, 2))
+        cov[:] = np.identity(2)
+        found = np.zeros(len(self), dtype=bool)
+        status = np.empty(len(self), dtype=np.uint8)
+        status.fill(STATUS_PREDICTED)
+        fits = [{} for i in range(len(self))]
+        if config.Tracking_batchFittingOn:
+            guesses = guesser_batch(npimage, x_p, y_p, self.radius, hints = self.hints,
+                                    status = status, fits = fits)
+        else:
+            guesses = []
+            for i in range(len(self)):
+                outcome = {}
+                guesses.append(guesser(npimage, x_p[i], y_p[i], self.radius[i],
+                                       hint = self.hints[i], fit = fits[i], outcome = outcome))
+                if guesses[i] is None:
+                    status[i] = outcome.get("status", STATUS_PREDICTED)
+        for i, guess in enumerate(guesses):
+            if guess is not None:
+                z[i, 0], z[i, 1], cov[i] = guess
+                found[i] = True
+        # spot in validation region?  (based on residual covariance)
+        with timers("gate"):
+            gated = self.kalman.measurement_distance(z, cov) > config.Tracking_gamma
+        if (found & gated).any():
+            diagnostics.event("gated", np.count_nonzero(found & gated))
+        with timers("update"):
+            self.kalman.update(z, cov, found & ~gated)
+        # only accepted fits are start values for the next energy
+        accepted = found & ~gated
+        self.hints = [fit if accepted[i] else {} for i, fit in enumerate(fits)]
+        status[found] = STATUS_FOUND
+        status[found & gated] = STATUS_GATED
+        if self.lattice is not None:
+            with timers("lattice"):
+                measured = found & ~gated
+                self.lattice.fit(z, measured, energy, config.Tracking_latticeMinSpots)
+                if self.lattice.fitted and not measured.all():
+                    # place the lost spots by the fitted model
+                    R = np.empty((len(self), 2, 2))
+                    R[:] = np.identity(2) * max(self.lattice.sigma, config.Tracking_latticeMinSigma)**2
+                    self.kalman.update(self.lattice.positions(), R, ~measured)
+                    status[~measured] |= STATUS_LATTICE
+        # windows clipped at the image border (as in adjust_slice)
+        height, width = npimage.shape[:2]
+        clipped = ((np.trunc(x_p - self.radius) < 0) | (np.trunc(x_p + self.radius + 1) > width) |
+                   (np.trunc(y_p - self.radius) < 0) | (np.trunc(y_p + self.radius + 1) > height))
+        status[clipped] |= STATUS_CLIPPED
+        self.status = status
+        xs, ys = self.kalman.get_position()
+        with timers("integrate"):
+            intensities = tracking_integrator().intensities(npimage, xs, ys, self.radius,
+                    background_substraction=config.Processing_backgroundSubstractionOn)
+        return [(x, y, intensity, energy, radius)
+                for x, y, intensity, radius in zip(xs, ys, intensities, self.radius)]
+
 def guess_from_Gaussian(image, *args, **kwargs):
-    """ Guess position of spot from a Gaussian fit. """
+    """ Guess position of spot from a Gaussian fit.
+
+    outcome: dict receiving the status of a failed fit (see report_failure)
+    """
+    outcome = kwargs.get("outcome")
     # construct circle where data is fit
     radius = 0.5 * min(image.shape)
     distances = calc_distances(image.shape, radius - 0.5, radius - 0.5, radius)
@@ -86,7 +359,7 @@ def guess_from_Gaussian(image, *args, **kwargs):
     p_cov = output[1]
     infodict = output[2]
     if infodict["nfev"] >= 150 or p_cov is None:
-        print "fit failed"
+        report_failure("fit_failed", outcome)
         return None
     # residual sum of squares sum (x_i - f_i)^2
     sum_of_squares_regression = (errfunc(p_opt)**2).sum()
@@ -95,7 +368,7 @@ def guess_from_Gaussian(image, *args, **kwargs):
     # calculate R^2
     Rsq = 1 - sum_of_squares_regression / sum_of_squares_total
     if Rsq < config.Tracking_minRsq:
-        print "Rsq to low"
+        report_failure("low_rsq", outcome)
         return None
     # estimate sigma^2 from a chi^2 equivalent
     s_sq = sum_of_squares_regression/(len(image.flatten())-len(params))
@@ -105,22 +378,227 @@ def guess_from_Gaussian(image, *args, **kwargs):
     y_res = p_opt[2]
     return (x_res, y_res), p_cov
 
-def guesser(npimage, x_in, y_in, radius, func = eval(config.Tracking_guessFunc), max_radius = 20, kalman = None, default_cov=np.diag([2, 2])):
-    def failure(reason):
-        logger.info("no guess, because " + reason)
-        print reason
+# coordinate grids and circle masks of the fit windows, by window shape
+_fit_grids = {}
+
+def fit_grid(shape):
+    """ Returns the row and column coordinates of the pixels inside the
+    circle used for fitting and the circle mask for a window shape. """
+    try:
+        return _fit_grids[shape]
+    except KeyError:
+        if len(_fit_grids) > 256:
+            _fit_grids.clear()
+        radius = 0.5 * min(shape)
+        distances = calc_distances(shape, radius - 0.5, radius - 0.5, radius)
+        circle = distances <= radius**2
+        X, Y = np.indices(shape)
+        _fit_grids[shape] = X[circle].astype(float), Y[circle].astype(float), circle
+        return _fit_grids[shape]
+
+""" Keys of the hint dictionaries (fit results kept between energies). """
+HINT_NAMES = ("height", "width_x", "width_y")
+
+def guess_from_Gaussian_fast(image, hint=None, fit=None, outcome=None, *args, **kwargs):
+    """ Guess position of spot from a Gaussian fit with analytic Jacobian.
+
+    Gives the same results as guess_from_Gaussian with fewer evaluations.
+    hint: dict of the last fitted height and widths of this spot, used as
+          start values (optional); if the fit from them fails, it is
+          repeated from the start values of guess_from_Gaussian
+    fit: dict receiving the fitted height and widths after a successful fit
+         (optional), the caller stores it as hint once the position passed
+         the validation gate
+    outcome: dict receiving the status of a failed fit (see report_failure)
+    """
+    X, Y, circle = fit_grid(image.shape)
+    data = image[circle]
+
+    # generate good guesses for the Gaussian distribution
+    background = np.min(image)
+    params = moments(image-background)
+    params.append(background)
+    starts = [params]
+    if hint:
+        starts.insert(0, [hint["height"], params[1], params[2],
+                          hint["width_x"], hint["width_y"], background])
+
+    def errfunc(p):
+        height, center_x, center_y, width_x, width_y, offset = p
+        return height * np.exp(-(((center_x - X) / width_x)**2 + \
+                    ((center_y - Y) / width_y)**2) / 2) + offset - data
+
+    def jacobian(p):
+        height, center_x, center_y, width_x, width_y, offset = p
+        dx, dy = X - center_x, Y - center_y
+        gauss = np.exp(-((dx / width_x)**2 + (dy / width_y)**2) / 2)
+        scaled = height * gauss
+        jac = np.empty((len(X), 6))
+        jac[:, 0] = gauss
+        jac[:, 1] = scaled * dx / width_x**2
+        jac[:, 2] = scaled * dy / width_y**2
+        jac[:, 3] = scaled * dx**2 / width_x**3
+        jac[:, 4] = scaled * dy**2 / width_y**3
+        jac[:, 5] = 1
+        return jac
+
+    # variance of the data sum (x_i - <x>)^2
+    sum_of_squares_total = ((image-np.mean(image))**2).sum()
+    for start in starts:
+        # fit Gaussian, allowing the same number of evaluations as guess_from_Gaussian
+        # (one Jacobian costs as much as len(params) function evaluations there)
+        try:
+            output = optimize.leastsq(errfunc, start, Dfun=jacobian, full_output=True,
+                                      maxfev=200 // (len(params) + 1))
+        except:
+            return None
+        p_opt = output[0]
+        p_cov = output[1]
+        infodict = output[2]
+        if infodict["nfev"] + infodict["njev"] * len(params) >= 150 or p_cov is None:
+            failure = "fit_failed"
+            continue
+        # residual sum of squares sum (x_i - f_i)^2
+        sum_of_squares_regression = (errfunc(p_opt)**2).sum()
+        # calculate R^2
+        Rsq = 1 - sum_of_squares_regression / sum_of_squares_total
+        if Rsq < config.Tracking_minRsq:
+            failure = "low_rsq"
+            continue
+        break
+    else:
+        report_failure(failure, outcome)
         return None
+    if fit is not None:
+        fit.update(height=p_opt[0], width_x=abs(p_opt[3]), width_y=abs(p_opt[4]))
+    # estimate sigma^2 from a chi^2 equivalent
+    s_sq = sum_of_squares_regression/(len(image.flatten())-len(params))
+    p_cov *= s_sq
+    p_cov = p_cov[1:3, 1:3]
+    x_res = p_opt[1]
+    y_res = p_opt[2]
+    return (x_res, y_res), p_cov
+
+# pixel coordinates (rows, columns) and fit circle masks by window shape
+_centroid_grids = {}
+
+def centroid_grid(shape):
+    """ Returns the flattened row and column coordinates of a window shape
+    and the mask of the circle used for fitting (see fit_grid). """
+    try:
+        return _centroid_grids[shape]
+    except KeyError:
+        if len(_centroid_grids) > 256:
+            _centroid_grids.clear()
+        coordinates = np.indices(shape).reshape(2, -1).astype(float)
+        _centroid_grids[shape] = coordinates, fit_grid(shape)[2].ravel()
+        return _centroid_grids[shape]
+
+def guess_from_centroid(image, aperture=0.3, max_iterations=20, tolerance=0.01, outcome=None,
+                        *args, **kwargs):
+    """ Guess position of spot from its windowed centroid (no fit).
+
+    The background (median outside the circle used for fitting) is
+    subtracted and the centroid is weighted with a Gaussian window, whose
+    width starts at aperture times the radius of the fit circle and
+    follows the width of the spot estimated from the weighted second
+    moments. The window is re-centred until it moves less than tolerance
+    pixel. The covariance is estimated from the counting statistics and
+    the noise of the background.
+
+    If the centroid does not converge to a spot within the fit circle or
+    the Gaussian with the estimated widths does not reach
+    config.Tracking_minRsq, the position is fitted with
+    guess_from_Gaussian_fast (the keyword arguments are passed on).
+    """
+    coordinates, circle = centroid_grid(image.shape)
+    data = np.asarray(image, dtype=float).ravel()
+    outside = np.sort(data[~circle])
+    if len(outside):
+        background, noise = outside[len(outside) // 2], outside.std()
+    else:
+        background, noise = data.min(), 0.0
+    signal = data - background
+    radius = 0.5 * min(image.shape)
+    middle = np.array([0.5 * image.shape[0] - 0.5, 0.5 * image.shape[1] - 0.5])
+    center = middle.copy()
+    width_sq = np.full(2, (aperture * radius)**2)
+    converged = False
+    for iteration in range(max_iterations):
+        offsets = coordinates - center[:, np.newaxis]
+        weights = signal * np.exp(-(offsets**2 / width_sq[:, np.newaxis]).sum(axis=0) / 2)
+        total = weights.sum()
+        if total <= 0:
+            break
+        # the weighted moments are those of the spot times the window
+        variance = np.dot(offsets**2, weights) / total
+        if not np.all((variance > 0) & (variance < width_sq)):
+            break
+        factor = width_sq / (width_sq - variance)
+        shift = factor * np.dot(offsets, weights) / total
+        center += shift
+        width_sq = np.minimum(variance * factor, radius**2)
+        if np.hypot(*(center - middle)) > radius:
+            break
+        if np.hypot(*shift) < tolerance:
+            converged = True
+            break
+    if not converged:
+        return guess_from_Gaussian_fast(image, outcome=outcome, **kwargs)
+    offsets = coordinates - center[:, np.newaxis]
+    # coefficient of determination of the Gaussian with the estimated widths
+    gauss = np.exp(-(offsets**2 / width_sq[:, np.newaxis]).sum(axis=0) / 2)
+    height = np.dot(gauss[circle], signal[circle]) / np.dot(gauss[circle], gauss[circle])
+    model = height * gauss + background
+    sum_of_squares_regression = ((model - data)[circle]**2).sum()
+    sum_of_squares_total = ((data - data.mean())**2).sum()
+    Rsq = 1 - sum_of_squares_regression / sum_of_squares_total
+    if Rsq < config.Tracking_minRsq:
+        return guess_from_Gaussian_fast(image, outcome=outcome, **kwargs)
+    # counting statistics of the spot and noise of the background pixels,
+    # propagated with the derivatives of the centroid by the pixel values
+    derivatives = gauss * (factor / total)[:, np.newaxis] * offsets
+    p_cov = np.dot(derivatives * (np.maximum(signal, 0) + noise**2), derivatives.T)
+    return (center[0], center[1]), p_cov
+
+""" Dictionary of available spot identification functions (see config.Tracking_guessFunc). """
+GUESS_FUNCS = {"guess_from_Gaussian": guess_from_Gaussian,
+               "guess_from_Gaussian_fast": guess_from_Gaussian_fast,
+               "guess_from_centroid": guess_from_centroid}
+
+def guesser(npimage, x_in, y_in, radius, func = None, max_radius = 20, kalman = None, default_cov=np.diag([2, 2]),
+            outcome = None, **kwargs):
+    """ Guesses the spot position in a window around x_in, y_in.
+
+    func: spot identification function (default: config.Tracking_guessFunc)
+    outcome: dict receiving the STATUS_* value of the spot as "status" if no
+             position is found (optional, see report_failure)
+    kwargs: passed on to func
+
+    If no position is found, None is returned.
+    """
+    if func is None:
+        func = GUESS_FUNCS[config.Tracking_guessFunc]
+    if outcome is None:
+        outcome = {}
     try:
-        factor = 1.0
-        x_min, x_max, y_min, y_max = adjust_slice(npimage, x_in - factor * radius, x_in + factor * radius + 1,
-                                     y_in - factor * radius, y_in + factor * radius + 1)
+        with timers("window"):
+            factor = 1.0
+            x_min, x_max, y_min, y_max = adjust_slice(npimage, x_in - factor * radius, x_in + factor * radius + 1,
+                                         y_in - factor * radius, y_in + factor * radius + 1)
+            image = npimage[y_min : y_max, x_min : x_max]
     except IndexError:
-       return failure("position outside image")
+        report_failure("outside_image", outcome)
+        return None
    
-    image = npimage[y_min : y_max, x_min : x_max]
-    result = func(image, x_mid = x_in - x_min, y_mid = y_in - y_min, size = radius)
+    with timers("fit"):
+        result = func(image, x_mid = x_in - x_min, y_mid = y_in - y_min, size = radius,
+                      outcome = outcome, **kwargs)
     if result is None:
-        return failure("fit failed")
+        # functions without own report
+        if "status" not in outcome:
+            report_failure("fit_failed", outcome)
+        return None
     pos, cov = result
     y_res, x_res = pos
     x_res += x_min
@@ -128,6 +606,182 @@ def guesser(npimage, x_in, y_in, radius, func = eval(config.Tracking_guessFunc),
     
     return x_res, y_res, cov
     
+def guesser_batch(npimage, x_in, y_in, radius, hints=None, status=None, fits=None,
+                  ftol=1.49012e-8, xtol=1.49012e-8):
+    """ Guesses the positions of many spots at once.
+
+    The windows of all spots are stacked into one zero-padded array and
+    gaussian2d is fitted to all of them simultaneously by a vectorized
+    Levenberg-Marquardt iteration, with the same start values, R^2 gating
+    and covariance estimate as guess_from_Gaussian_fast.
+
+    x_in, y_in, radius: arrays with the window centers and radii
+    hints: list with a hint dict per spot (see guess_from_Gaussian_fast),
+           the fits from hints that fail are repeated without them
+    fits: list receiving the fitted height and widths of every spot in a
+          dict (see guess_from_Gaussian_fast, optional)
+    status: array receiving the STATUS_* value of the spots without
+            result (optional)
+    Returns a list with (x, y, cov) or None for every spot (see guesser).
+    """
+    n_spots = len(x_in)
+    results = [None] * n_spots
+    with timers("window"):
+        windows = []
+        for i in range(n_spots):
+            try:
+                x_min, x_max, y_min, y_max = adjust_slice(npimage, x_in[i] - radius[i], x_in[i] + radius[i] + 1,
+                                                          y_in[i] - radius[i], y_in[i] + radius[i] + 1)
+            except IndexError:
+                diagnostics.event("outside_image")
+                if status is not None:
+                    status[i] = STATUS_OUTSIDE_IMAGE
+                continue
+            windows.append((i, x_min, y_min, npimage[y_min : y_max, x_min : x_max]))
+        if not windows:
+            return results
+
+        # stack windows, pixels outside the fit circle get zero weight
+        height = max(window.shape[0] for i, x_min, y_min, window in windows)
+        width = max(window.shape[1] for i, x_min, y_min, window in windows)
+        n = len(windows)
+        data = np.zeros((n, height, width))
+        circles = np.zeros((n, height, width), dtype=bool)
+        params = np.empty((n, 6))
+        sum_of_squares_total = np.empty(n)
+        dof = np.empty(n)
+        for k, (i, x_min, y_min, window) in enumerate(windows):
+            h, w = window.shape
+            data[k, :h, :w] = window
+            circles[k, :h, :w] = fit_grid(window.shape)[2]
+            background = np.min(window)
+            params[k, :5] = moments(window - background)
+            params[k, 5] = background
+            if hints is not None and hints[i]:
+                params[k, 0] = hints[i]["height"]
+                params[k, 3] = hints[i]["width_x"]
+                params[k, 4] = hints[i]["width_y"]
+            sum_of_squares_total[k] = ((window - np.mean(window))**2).sum()
+            dof[k] = window.size - params.shape[1]
+        X, Y = np.indices((height, width))
+        X = X.ravel().astype(float)
+        Y = Y.ravel().astype(float)
+        data = data.reshape(n, -1)
+        weights = circles.reshape(n, -1).astype(float)
+
+    with timers("fit"):
+        def residuals(p):
+            dx = X - p[:, 1, None]
+            dy = Y - p[:, 2, None]
+            gauss = np.exp(-((dx / p[:, 3, None])**2 + (dy / p[:, 4, None])**2) / 2)
+            res = (p[:, 0, None] * gauss + p[:, 5, None] - data_active) * weights_active
+            return res, gauss, dx, dy
+
+        def jacobian(p, gauss, dx, dy):
+            scaled = p[:, 0, None] * gauss
+            jac = np.empty(gauss.shape + (6,))
+            jac[..., 0] = gauss
+            jac[..., 1] = scaled * dx / p[:, 3, None]**2
+            jac[..., 2] = scaled * dy / p[:, 4, None]**2
+            jac[..., 3] = scaled * dx**2 / p[:, 3, None]**3
+            jac[..., 4] = scaled * dy**2 / p[:, 4, None]**3
+            jac[..., 5] = 1
+            return jac * weights_active[..., None]
+
+        # Levenberg-Marquardt with per-spot damping and convergence masks,
+        # allowing the same number of evaluations as guess_from_Gaussian_fast
+        max_iterations = 200 // (params.shape[1] + 1)
+        damping = np.ones(n) * 1e-3
+        active = np.ones(n, dtype=bool)
+        converged = np.zeros(n, dtype=bool)
+        data_active, weights_active = data, weights
+        res, gauss, dx, dy = residuals(params)
+        cost = (res**2).sum(axis=1)
+        jac = jacobian(params, gauss, dx, dy)
+        with np.errstate(all="ignore"):
+            for iteration in range(max_iterations):
+                idx = np.flatnonzero(active)
+                if not len(idx):
+                    break
+                data_active, weights_active = data[idx], weights[idx]
+                jacT = jac.transpose(0, 2, 1)
+                JTJ = np.matmul(jacT, jac)
+                JTr = np.matmul(jacT, res[..., None])[..., 0]
+                diagonal = np.einsum("nii->ni", JTJ)
+                A = JTJ + (damping[idx, None] * diagonal)[:, :, None] * np.identity(6)
+                try:
+                    step = -np.linalg.solve(A, JTr[..., None])[..., 0]
+                except np.linalg.LinAlgError:
+                    step = -np.matmul(np.linalg.pinv(A), JTr[..., None])[..., 0]
+                trial = params[idx] + step
+                trial_res, trial_gauss, trial_dx, trial_dy = residuals(trial)
+                trial_cost = (trial_res**2).sum(axis=1)
+                better = trial_cost <= cost[idx]
+                better &= np.isfinite(trial_cost)
+                small_reduction = better & (cost[idx] - trial_cost <= ftol * cost[idx])
+                small_step = np.sqrt((step**2).sum(axis=1)) <= xtol * np.sqrt((params[idx]**2).sum(axis=1))
+                # accept improving steps
+                params[idx[better]] = trial[better]
+                cost[idx[better]] = trial_cost[better]
+                damping[idx] = np.where(better, damping[idx] / 10, damping[idx] * 10)
+                done = small_reduction | small_step
+                converged[idx[done]] = True
+                active[idx[done]] = False
+                # keep the state of the spots that continue
+                keep = ~done
+                res = np.where(better[:, None], trial_res, res)[keep]
+                gauss = np.where(better[:, None], trial_gauss, gauss)[keep]
+                dx = np.where(better[:, None], trial_dx, dx)[keep]
+                dy = np.where(better[:, None], trial_dy, dy)[keep]
+                data_active, weights_active = data[idx[keep]], weights[idx[keep]]
+                jac = jacobian(params[idx[keep]], gauss, dx, dy)
+
+        # covariance from the Jacobian at the solution
+        data_active, weights_active = data, weights
+        res, gauss, dx, dy = residuals(params)
+        jac = jacobian(params, gauss, dx, dy)
+        sum_of_squares_regression = (res**2).sum(axis=1)
+        Rsq = 1 - sum_of_squares_regression / sum_of_squares_total
+        s_sq = sum_of_squares_regression / dof
+        retry = []
+        for k, (i, x_min, y_min, window) in enumerate(windows):
+            if not converged[k]:
+                p_cov = None
+            else:
+                try:
+                    p_cov = np.linalg.inv(np.dot(jac[k].T, jac[k]))
+                except np.linalg.LinAlgError:
+                    p_cov = None
+            if (p_cov is None or Rsq[k] < config.Tracking_minRsq) and hints is not None and hints[i]:
+                retry.append(i)
+                continue
+            if p_cov is None:
+                diagnostics.event("fit_failed")
+                if status is not None:
+                    status[i] = STATUS_FIT_FAILED
+                continue
+            if Rsq[k] < config.Tracking_minRsq:
+                diagnostics.event("low_rsq")
+                if status is not None:
+                    status[i] = STATUS_LOW_RSQ
+                continue
+            if fits is not None:
+                fits[i].update(height=params[k, 0], width_x=abs(params[k, 3]), width_y=abs(params[k, 4]))
+            p_cov = p_cov[1:3, 1:3] * s_sq[k]
+            results[i] = params[k, 2] + x_min, params[k, 1] + y_min, p_cov
+    if retry:
+        # start from the moments as guess_from_Gaussian_fast does
+        retry_status = None if status is None else status[retry]
+        retry_fits = None if fits is None else [fits[i] for i in retry]
+        retry_results = guesser_batch(npimage, np.asarray(x_in)[retry], np.asarray(y_in)[retry],
+                                      np.asarray(radius)[retry], status=retry_status, fits=retry_fits,
+                                      ftol=ftol, xtol=xtol)
+        for i, result in zip(retry, retry_results):
+            results[i] = result
+        if status is not None:
+            status[retry] = retry_status
+    return results
+
 def gaussian2d(height, center_x, center_y, width_x, width_y = None,
                 offset=0):
     """Returns a two dimensional gaussian function with the given parameters"""
@@ -181,7 +835,7 @@ def adjust_slice(image, x_sl_min, x_sl_max, y_sl_min, y_sl_max):
                 indices[i] = ymax
                 adjusted = True
     if adjusted:
-        logger.warning("slice had to be adjusted to fit image.")
+        diagnostics.event("clipped_window")
     if not int(indices[0] - indices[1]) or not int(indices[2] - indices[3]):
         raise IndexError()
     return tuple(indices)
@@ -199,12 +853,168 @@ def calc_distances(shape, x, y, squared = True):
         distances = distances**.5
     return distances
 
+class StencilIntegrator(object):
+    """ Integrates spots over a small window around each spot.
+
+    The disk and annulus masks (stencils) depend only on the radius and the
+    sub-pixel offset of the spot center and are kept in a LRU cache. With
+    bins > 0 the offset is rounded to the center of one of bins x bins
+    sub-pixel bins, i.e. the result is identical to the full image
+    calculation at a position at most 0.5 / bins pixel away in x and y.
+    The radius is rounded in the same way to radius_bins steps per pixel,
+    so that the stencils are reused while the windows are scaled with the
+    energy (radius_bins = None: exact radius, no reuse with scaled windows).
+    With bins = None the results are identical to the full image calculation.
+    """
+
+    def __init__(self, bins=config.Processing_stencilBins,
+                    cache_size=config.Processing_stencilCacheSize,
+                    radius_bins=config.Processing_stencilRadiusBins):
+        self.bins = bins
+        self.radius_bins = radius_bins
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def stencil(self, radius, x_offset, y_offset):
+        """ Returns (disk, annulus, half width) of the stencil for a spot
+        at the given sub-pixel offset (0 <= offset < 1). """
+        if self.bins:
+            x_bin = min(int(x_offset * self.bins), self.bins - 1)
+            y_bin = min(int(y_offset * self.bins), self.bins - 1)
+            if self.radius_bins:
+                r_bin = int(round(radius * self.radius_bins))
+                radius = r_bin / float(self.radius_bins)
+            else:
+                r_bin = radius
+            key = (r_bin, x_bin, y_bin)
+            stencil = self.cache.pop(key, None)
+            if stencil is not None:
+                self.hits += 1
+                self.cache[key] = stencil
+                return stencil
+            self.misses += 1
+            x_offset = (x_bin + 0.5) / self.bins
+            y_offset = (y_bin + 0.5) / self.bins
+        # window has to contain the annulus up to sqrt(2) * radius
+        half = int(np.ceil(2**0.5 * radius)) + 1
+        yind, xind = np.ogrid[-half:half + 1, -half:half + 1]
+        distances = (yind - y_offset)**2 + (xind - x_offset)**2
+        disk = distances <= radius**2
+        annulus = np.logical_and(distances >= radius**2, distances <= 2 * radius**2)
+        stencil = disk, annulus, half
+        if self.bins:
+            self.cache[key] = stencil
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return stencil
+
+    def window(self, npimage, x, y, radius):
+        """ Returns the image window around x, y and the disk and annulus
+        masks for it (clipped at the image borders). """
+        x_int, y_int = int(np.floor(x)), int(np.floor(y))
+        disk, annulus, half = self.stencil(radius, x - x_int, y - y_int)
+        ymax, xmax = npimage.shape
+        x_min, y_min = x_int - half, y_int - half
+        x_lo, x_hi = max(x_min, 0), max(min(x_int + half + 1, xmax), 0)
+        y_lo, y_hi = max(y_min, 0), max(min(y_int + half + 1, ymax), 0)
+        stencil_slice = (slice(y_lo - y_min, max(y_hi - y_min, 0)),
+                         slice(x_lo - x_min, max(x_hi - x_min, 0)))
+        return npimage[y_lo:y_hi, x_lo:x_hi], disk[stencil_slice], annulus[stencil_slice]
+
+    def intensity(self, npimage, x, y, radius, background_substraction=True):
+        """ Calculates the intensity of a spot (see calc_intensity). """
+        window, disk, annulus = self.window(npimage, x, y, radius)
+        intensities = window[disk]
+        intensity, area = np.sum(intensities), len(intensities)
+        if background_substraction:
+            # average background intensity over annulus with approximately equal area
+            intensity -= np.mean(window[annulus]) * area
+        return intensity
+
+    def windows(self, npimage, x, y, radius):
+        """ Returns the windows around many spots as one stack and the disk
+        and annulus masks for them (pixels outside the image masked out).
+
+        x, y, radius: arrays with one entry per spot (not empty)
+        """
+        x, y, radius = [np.asarray(v, dtype=float) for v in np.broadcast_arrays(x, y, radius)]
+        x_int, y_int = np.floor(x).astype(int), np.floor(y).astype(int)
+        stencils = [self.stencil(r, xo, yo) for r, xo, yo in zip(radius, x - x_int, y - y_int)]
+        half = max(stencil[2] for stencil in stencils)
+        size = 2 * half + 1
+        disks = np.zeros((len(x), size, size), dtype=bool)
+        annuli = np.zeros((len(x), size, size), dtype=bool)
+        for k, (disk, annulus, h) in enumerate(stencils):
+            window = slice(half - h, half + h + 1)
+            disks[k, window, window] = disk
+            annuli[k, window, window] = annulus
+        offsets = np.arange(-half, half + 1)
+        rows = y_int[:, np.newaxis] + offsets
+        columns = x_int[:, np.newaxis] + offsets
+        ymax, xmax = npimage.shape
+        inside = np.logical_and(rows >= 0, rows < ymax)[:, :, np.newaxis] & \
+                 np.logical_and(columns >= 0, columns < xmax)[:, np.newaxis, :]
+        windows = npimage[np.clip(rows, 0, ymax - 1)[:, :, np.newaxis],
+                          np.clip(columns, 0, xmax - 1)[:, np.newaxis, :]].astype(float)
+        disks &= inside
+        annuli &= inside
+        return windows, disks, annuli
+
+    def intensities(self, npimage, x, y, radius, background_substraction=True):
+        """ Calculates the intensities of many spots at once (see intensity).
+
+        x, y, radius: arrays with one entry per spot
+
+        All windows are gathered into one stack (see windows).
+        """
+        if not np.size(x):
+            return np.empty(0)
+        windows, disks, annuli = self.windows(npimage, x, y, radius)
+        area = disks.sum(axis=(1, 2))
+        intensity = np.where(disks, windows, 0).sum(axis=(1, 2))
+        if background_substraction:
+            background = np.where(annuli, windows, 0).sum(axis=(1, 2)) / annuli.sum(axis=(1, 2))
+            intensity -= background * area
+        return intensity
+
+    def signal_to_background(self, npimage, x, y, radius):
+        """ Calculates the signal to background ratio of a spot. """
+        window, disk, annulus = self.window(npimage, x, y, radius)
+        return np.mean(window[disk]) / np.mean(window[annulus])
+
+    def signals_to_background(self, npimage, x, y, radius):
+        """ Calculates the signal to background ratios of many spots at once. """
+        if not np.size(x):
+            return np.empty(0)
+        windows, disks, annuli = self.windows(npimage, x, y, radius)
+        signal = np.where(disks, windows, 0).sum(axis=(1, 2)) / disks.sum(axis=(1, 2))
+        background = np.where(annuli, windows, 0).sum(axis=(1, 2)) / annuli.sum(axis=(1, 2))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return signal / background
+
+# exact integration used by calc_intensity and signal_to_background
+exact_integrator = StencilIntegrator(bins=None)
+# integrators with cached stencils by (bins, radius_bins), see tracking_integrator
+_binned_integrators = {}
+
+def tracking_integrator():
+    """ Returns the integrator used by the trackers: exact_integrator, or
+    with config.Processing_stencilBins set one with cached stencils (opt-in,
+    the intensities then differ slightly from the exact ones). """
+    if not config.Processing_stencilBins:
+        return exact_integrator
+    key = (config.Processing_stencilBins, config.Processing_stencilRadiusBins)
+    if key not in _binned_integrators:
+        _binned_integrators[key] = StencilIntegrator(bins=key[0], radius_bins=key[1],
+                cache_size=config.Processing_stencilCacheSize)
+    return _binned_integrators[key]
+
 def signal_to_background(npimage, x, y, radius):
-    distances = calc_distances(npimage.shape, x, y)
-    signal = np.mean(npimage[distances <= radius**2])
-    # average background intensity over annulus with equal area
-    background = np.mean(npimage[np.logical_and(distances >= radius**2, distances <= 2 * radius**2)])
-    return signal/background
+    """ Calculates the ratio of the mean intensity of a spot to the mean
+    intensity of the surrounding annulus with equal area. """
+    return exact_integrator.signal_to_background(npimage, x, y, radius)
   
 def calc_intensity(npimage, x, y, radius, background_substraction=config.Processing_backgroundSubstractionOn):
     """ Calculates the intensity of a spot.
@@ -214,12 +1024,4 @@ def calc_intensity(npimage, x, y, radius, background_substraction=config.Process
         radius: radius of the spot
         background_substraction: boolean to turn substraction on/off
     """
-    yind, xind = np.indices(npimage.shape)
-    distances = ((yind - y)**2 + (xind - x)**2)
-    intensities = npimage[distances <= radius**2]
-    intensity, area = np.sum(intensities), len(intensities)
-    if background_substraction:
-        # average background intensity over annulus with approximately equal area
-        background_intensities = npimage[np.logical_and(distances >= radius**2, distances <= 2 * radius**2)]
-        intensity -= np.mean(background_intensities) * area
-    return intensity
+    return exact_integrator.intensity(npimage, x, y, radius, background_substraction)
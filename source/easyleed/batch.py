@@ -0,0 +1,541 @@
+"""
+easyleed.batch
+--------------
+
+Headless tracking of spots through an energy series (no PyQt4 needed).
+
+The module can also be run from the command line::
+
+    python -m easyleed.batch detect -o spots.txt images/
+    python -m easyleed.batch track -s spots.txt -o result images/
+    python -m easyleed.batch resume result.ckpt
+    python -m easyleed.batch reintegrate -o new result.res images/
+    python -m easyleed.batch export result.res
+    python -m easyleed.batch convert -o series.h5 images/
+
+"""
+
+import os
+import json
+import pickle
+import argparse
+import logging
+
+import numpy as np
+
+from . import config
+from .base import TrackerBank, ResultStore, tracking_integrator, logger
+from .timing import timers
+from .diagnostics import diagnostics
+from .io import IMAGE_FORMATS, get_format, find_images, ResultWriter, ResultFile
+
+""" Names of the config entries in the order they are stored in a parameter file. """
+PARAMETER_NAMES = ["Tracking_inputPrecision", "Tracking_windowScalingOn",
+        "Tracking_minWindowSize", "Tracking_guessFunc", "Tracking_gamma",
+        "Tracking_minRsq", "Processing_backgroundSubstractionOn",
+        "Tracking_processNoise"]
+
+def load_parameters(filename):
+    """ Loads a parameter file (as saved by the GUI) into the config module. """
+    with open(filename, "rb") as f:
+        values = pickle.load(f)
+    set_parameters(dict(zip(PARAMETER_NAMES, values)))
+
+def set_parameters(parameters):
+    """ Sets the config entries of a dictionary as returned by
+    current_parameters (missing entries are left unchanged). """
+    for name in PARAMETER_NAMES:
+        if name not in parameters:
+            continue
+        value = parameters[name]
+        if name == "Tracking_processNoise":
+            value = np.diag(value)
+        elif name == "Tracking_guessFunc":
+            value = str(value)
+        setattr(config, name, value)
+
+def config_values():
+    """ Returns the tracking related entries of the config module. """
+    return dict((name, getattr(config, name)) for name in dir(config)
+                if name.startswith("Tracking_") or name.startswith("Processing_"))
+
+def current_parameters():
+    """ Returns the parameters of PARAMETER_NAMES as a JSON compatible dictionary. """
+    parameters = {}
+    for name in PARAMETER_NAMES:
+        value = getattr(config, name)
+        if name == "Tracking_processNoise":
+            value = np.diagonal(value).tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        parameters[name] = value
+    return parameters
+
+def load_spots(filename):
+    """ Loads spot seeds from a text file with the columns x, y, radius. """
+    spots = np.loadtxt(filename, ndmin=2)
+    if spots.shape[1] != 3:
+        raise IOError("Spot file needs three columns: x, y, radius.")
+    return [tuple(spot) for spot in spots]
+
+def save_spots(filename, spots):
+    """ Saves spot seeds to a text file with the columns x, y, radius. """
+    np.savetxt(filename, np.asarray(spots, dtype=float).reshape(-1, 3), fmt="%f")
+
+def save_results(filename, results):
+    """ Saves intensities to filename.int and positions to filename.pos.
+
+    results: ResultStore or ResultFile
+    """
+    np.savetxt(filename + ".int", np.column_stack((results.energy, results.intensity.T)))
+    np.savetxt(filename + ".pos", np.column_stack((results.energy, results.x.T, results.y.T)))
+
+class TrackingEngine(object):
+    """ Tracks a set of spots through a series of images.
+
+    The engine holds a TrackerBank and a ResultStore and does not depend
+    on any GUI functionality.
+    """
+
+    def __init__(self, spots, energy, n_energies=0):
+        """
+        spots: list of (x, y, radius) start positions
+        energy: energy at which the start positions were determined
+        n_energies: expected number of images (preallocates the results)
+        """
+        self.spots = list(spots)
+        self.energy = energy
+        x, y, radius = np.asarray(spots, dtype=float).reshape(-1, 3).T
+        self.trackers = TrackerBank(x, y, radius, energy,
+                        input_precision = config.Tracking_inputPrecision,
+                        window_scaling = config.Tracking_windowScalingOn,
+                        lattice = config.Tracking_latticeOn)
+        self.results = ResultStore(len(self.trackers), n_energies)
+        # per spot views of the results (SpotModel interface)
+        self.models = [self.results.spot(i) for i in range(len(self.trackers))]
+        # ResultWriter receiving every energy as soon as it is processed (optional)
+        self.writer = None
+        self.stopped = False
+
+    def process(self, image):
+        """ Feeds one (npimage, energy) tuple to all trackers.
+
+        Returns the list of (x, y, intensity, energy, radius) results.
+        """
+        results = self.trackers.feed_image(image)
+        self.store(results, self.trackers.status)
+        return results
+
+    def store(self, results, status):
+        """ Adds the results of one energy to the result store and writer. """
+        with timers("store"):
+            self.results.append(results, status)
+            if self.writer is not None:
+                self.writer.append(results, status)
+
+    def run(self, images, callback=None):
+        """ Processes all images until exhausted or stop() is called.
+
+        callback: called with (image, results) after each image (optional)
+
+        The stage timers and the counters of the tracking events are reset
+        at the start, their summaries are logged at the end (see
+        timing.timers and diagnostics.diagnostics).
+        """
+        self.stopped = False
+        timers.reset()
+        diagnostics.reset()
+        try:
+            for image in images:
+                if self.stopped:
+                    break
+                results = self.process(image)
+                if callback is not None:
+                    callback(image, results)
+        finally:
+            self.close()
+        timers.log_summary()
+        diagnostics.log_summary()
+
+    def close(self):
+        """ Releases the resources of the engine (called at the end of run). """
+        pass
+
+    def stop(self):
+        """ Stops a running run() after the current image. """
+        self.stopped = True
+
+    def save(self, filename):
+        """ Saves intensities and positions (see save_results). """
+        save_results(filename, self.results)
+
+    def get_state(self):
+        """ Returns the tracker state and the results so far as a dictionary of arrays. """
+        state = dict(("tracker_" + name, value)
+                     for name, value in self.trackers.get_state().iteritems())
+        state.update(("results_" + name, value)
+                     for name, value in self.results.get_state().iteritems())
+        return state
+
+    def set_state(self, state):
+        """ Restores a state returned by get_state. """
+        for prefix, target in (("tracker_", self.trackers), ("results_", self.results)):
+            target.set_state(dict((name[len(prefix):], value)
+                    for name, value in state.iteritems() if name.startswith(prefix)))
+
+def save_checkpoint(filename, engine, arguments=None):
+    """ Saves the complete state of an engine after the last processed image.
+
+    arguments: dictionary stored along (e.g. the command line arguments)
+    """
+    state = engine.get_state()
+    state["spots"] = np.asarray(engine.spots, dtype=float)
+    state["energy"] = engine.energy
+    state["config"] = pickle.dumps(config_values(), 0)
+    state["arguments"] = json.dumps(arguments or {})
+    # write to a temporary file first, so that a crash keeps the old checkpoint
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as f:
+        np.savez(f, **state)
+    os.rename(temporary, filename)
+
+def load_checkpoint(filename):
+    """ Loads a checkpoint and restores the config values stored in it.
+
+    Returns the engine state, spots, start energy and stored arguments.
+    """
+    with np.load(filename) as content:
+        state = dict((name, content[name]) for name in content.files)
+    for name, value in pickle.loads(str(state.pop("config"))).iteritems():
+        setattr(config, name, value)
+    arguments = json.loads(str(state.pop("arguments")))
+    spots = [tuple(spot) for spot in state.pop("spots")]
+    energy = state.pop("energy").item()
+    return state, spots, energy, arguments
+
+def make_loader(paths, format_name=None, prefetch=None):
+    """ Creates an ImageLoader for the given files and/or directories.
+
+    format_name: abbreviation of the image format (default: from file extension)
+    prefetch: number of images to read ahead (default: config.IO_prefetch)
+    """
+    format_ = None
+    if format_name is not None:
+        formats = [f for f in IMAGE_FORMATS.itervalues() if f.abbrev == format_name.upper()]
+        if not formats:
+            raise IOError("Image format %s is not available." % format_name)
+        format_ = formats[0]
+    image_paths = find_images(paths, format_)
+    if not image_paths:
+        raise IOError("No image files found.")
+    if format_ is None:
+        formats = set(get_format(path).abbrev for path in image_paths)
+        if len(formats) > 1:
+            raise IOError("Mixed image formats, please choose one with --format.")
+        format_ = get_format(image_paths[0])
+    if prefetch is None:
+        prefetch = config.IO_prefetch
+    return format_.loader(image_paths, config.IO_energyRegex, prefetch=prefetch,
+                          use_index=config.IO_useIndex, cache_size=config.IO_cacheSize)
+
+def seek(loader, energy):
+    """ Positions the loader just before the given energy. """
+    loader.restart()
+    if energy is None:
+        return loader.energies[0]
+    if energy not in loader.energies:
+        raise IOError("No image at energy %s." % energy)
+    loader.index = loader.energies.index(energy) - 1
+    return energy
+
+def make_engine(spots, energy, n_energies, processes=None):
+    """ Creates a serial or parallel engine.
+
+    processes: number of processes (0: number of CPUs, default: config.Tracking_processes)
+    """
+    processes = config.Tracking_processes if processes is None else processes
+    if processes == 1:
+        return TrackingEngine(spots, energy, n_energies)
+    from .parallel import ParallelTrackingEngine
+    return ParallelTrackingEngine(spots, energy, n_energies, processes or None)
+
+def track(args):
+    if args.parameters:
+        load_parameters(args.parameters)
+    loader = make_loader(args.input, args.format, args.prefetch)
+    energy = seek(loader, args.energy)
+    spots = load_spots(args.spots)
+    engine = make_engine(spots, energy, len(loader.energies) - loader.index - 1, args.processes)
+    engine.writer = ResultWriter(args.output + ".res", spots, current_parameters())
+    run_engine(engine, loader, args)
+
+# loader of a reintegration worker process (see reintegrate)
+_loader = None
+
+def start_reintegration(paths, format_name, values):
+    """ Initializes a reintegration worker process. """
+    global _loader
+    for name, value in values.iteritems():
+        setattr(config, name, value)
+    _loader = make_loader(paths, format_name, prefetch=0)
+
+def integrate_energy(task):
+    """ Integrates all spots in the image at one energy.
+
+    task: (energy, x, y, radius) with arrays x, y, radius of all spots
+    """
+    energy, x, y, radius = task
+    npimage = _loader.get_image(_loader.files[energy])
+    return tracking_integrator().intensities(npimage, x, y, radius,
+            background_substraction=config.Processing_backgroundSubstractionOn)
+
+def reintegrate(results, paths, format_name=None, radius=None, processes=None):
+    """ Recalculates the intensities at stored positions with the current
+    integration settings (no fitting or tracking).
+
+    results: ResultStore or ResultFile with the positions
+    paths: image files and/or directories (see make_loader)
+    radius: array of integration radii (default: radii of the results)
+    processes: number of processes the energies are distributed over
+               (0: number of CPUs, default: config.Tracking_processes)
+
+    Returns the intensities as an array of shape (n_spots, n_energies).
+    """
+    if radius is None:
+        radius = results.radius
+    radius = np.broadcast_to(radius, results.x.shape)
+    tasks = [(energy, results.x[:, i], results.y[:, i], radius[:, i])
+             for i, energy in enumerate(results.energy)]
+    processes = config.Tracking_processes if processes is None else processes
+    if processes == 1:
+        start_reintegration(paths, format_name, {})
+        intensities = map(integrate_energy, tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes or None, start_reintegration,
+                                    (paths, format_name, config_values()))
+        try:
+            intensities = pool.map(integrate_energy, tasks, chunksize=8)
+        finally:
+            pool.terminate()
+    return np.array(intensities).reshape(len(tasks), -1).T
+
+def reintegration(args):
+    # settings of the tracking, overridden by the given options only
+    results = ResultFile(args.results)
+    set_parameters(results.parameters)
+    if args.parameters:
+        load_parameters(args.parameters)
+    if args.background is not None:
+        config.Processing_backgroundSubstractionOn = args.background
+    radius = results.radius
+    if args.radius is not None:
+        radius = np.full(radius.shape, args.radius)
+    radius = radius * args.radius_scale
+    intensities = reintegrate(results, args.input, args.format, radius, args.processes)
+    parameters = results.parameters
+    parameters.update(current_parameters())
+    writer = ResultWriter(args.output + ".res", results.spots, parameters)
+    try:
+        for i, energy in enumerate(results.energy):
+            writer.append(zip(results.x[:, i], results.y[:, i], intensities[:, i],
+                              [energy] * results.n_spots, radius[:, i]), results.status[:, i])
+    finally:
+        writer.close()
+    if args.text:
+        save_results(args.output, ResultFile(args.output + ".res"))
+
+def resume(args):
+    state, spots, energy, arguments = load_checkpoint(args.checkpoint)
+    if args.processes is not None:
+        arguments["processes"] = args.processes
+    args = argparse.Namespace(**arguments)
+    loader = make_loader(args.input, args.format, args.prefetch)
+    # continue after the last energy in the checkpoint
+    count = len(state["results_energy"])
+    last = state["results_energy"][-1]
+    loader.restart()
+    if last not in loader.energies:
+        raise IOError("No image at energy %s." % last)
+    loader.index = loader.energies.index(last)
+    engine = make_engine(spots, energy, count + len(loader.energies) - loader.index - 1,
+                         args.processes)
+    engine.set_state(state)
+    engine.writer = ResultWriter.resume(args.output + ".res", count)
+    run_engine(engine, loader, args)
+
+def run_engine(engine, loader, args):
+    """ Runs a tracking from the command line, saving periodic checkpoints. """
+    interval = args.checkpoint_interval
+    if interval is None:
+        interval = config.IO_checkpointInterval
+    arguments = dict((name, value) for name, value in vars(args).iteritems()
+                     if name != "func")
+    def report(image, results):
+        logger.info("processed energy %s" % image[1])
+        if interval and len(engine.results) % interval == 0:
+            save_checkpoint(args.output + ".ckpt", engine, arguments)
+    try:
+        engine.run(loader, report)
+    finally:
+        engine.writer.close()
+        loader.close()
+    if args.text:
+        engine.save(args.output)
+
+def detect(args):
+    from .detection import detect_spots
+    if args.parameters:
+        load_parameters(args.parameters)
+    loader = make_loader(args.input, args.format, prefetch=0)
+    seek(loader, args.energy)
+    npimage, energy = loader.next()
+    loader.close()
+    spots = detect_spots(npimage, sigmas=args.sigma, min_snr=args.min_snr,
+                         min_distance=args.min_distance, max_spots=args.max_spots)
+    save_spots(args.output, spots)
+    logger.info("detected %d spots at energy %s" % (len(spots), energy))
+
+def export(args):
+    # with several result files the output has to be a directory
+    directory = args.output is not None and os.path.isdir(args.output)
+    if args.output is not None and not directory and len(args.input) > 1:
+        raise IOError("Several result files need an output directory, not a prefix.")
+    for filename in args.input:
+        results = ResultFile(filename)
+        output = os.path.splitext(filename)[0]
+        if directory:
+            output = os.path.join(args.output, os.path.basename(output))
+        elif args.output:
+            output = args.output
+        save_results(output, results)
+
+def convert(args):
+    from .io import write_cube
+    loader = make_loader(args.input, args.format, prefetch=args.prefetch)
+    chunks = None
+    if args.chunks:
+        chunks = tuple(int(c) for c in args.chunks.split(","))
+    write_cube(loader, args.output, compression=args.compression, chunks=chunks)
+    loader.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="easyleed",
+                    description="Headless LEED I(E)-spectra extraction.")
+    subparsers = parser.add_subparsers()
+
+    track_parser = subparsers.add_parser("track",
+                    help="track spots and write a result file")
+    track_parser.add_argument("input", nargs="+",
+                    help="image files or directories containing image files")
+    track_parser.add_argument("-s", "--spots", required=True,
+                    help="text file with the columns x, y, radius")
+    track_parser.add_argument("-o", "--output", required=True,
+                    help="output prefix of the result file (.res)")
+    track_parser.add_argument("-p", "--parameters",
+                    help="parameter file saved from the GUI")
+    track_parser.add_argument("-f", "--format",
+                    help="image format (%s)" % ", ".join(f.abbrev for f in IMAGE_FORMATS.itervalues()))
+    track_parser.add_argument("-e", "--energy", type=int,
+                    help="energy of the spot positions (default: lowest)")
+    track_parser.add_argument("-j", "--processes", type=int,
+                    help="number of processes (0: number of CPUs, default: config.Tracking_processes)")
+    track_parser.add_argument("--prefetch", type=int,
+                    help="number of images read ahead (default: config.IO_prefetch)")
+    track_parser.add_argument("-t", "--text", action="store_true",
+                    help="also write .int and .pos text files")
+    track_parser.add_argument("--checkpoint-interval", type=int,
+                    help="number of images between checkpoints (.ckpt, 0: none, "
+                         "default: config.IO_checkpointInterval)")
+    track_parser.set_defaults(func=track)
+
+    resume_parser = subparsers.add_parser("resume",
+                    help="continue an interrupted track command from its checkpoint")
+    resume_parser.add_argument("checkpoint",
+                    help="checkpoint file (.ckpt) written by track")
+    resume_parser.add_argument("-j", "--processes", type=int,
+                    help="number of processes (default: as in the interrupted run)")
+    resume_parser.set_defaults(func=resume)
+
+    reintegrate_parser = subparsers.add_parser("reintegrate",
+                    help="recalculate intensities at the positions of a result file")
+    reintegrate_parser.add_argument("results",
+                    help="result file (.res) with the spot positions")
+    reintegrate_parser.add_argument("input", nargs="+",
+                    help="image files or directories containing image files")
+    reintegrate_parser.add_argument("-o", "--output", required=True,
+                    help="output prefix of the new result file (.res)")
+    reintegrate_parser.add_argument("-p", "--parameters",
+                    help="parameter file saved from the GUI (default: parameters of the result file)")
+    reintegrate_parser.add_argument("-f", "--format",
+                    help="image format of the input files")
+    reintegrate_parser.add_argument("-r", "--radius", type=float,
+                    help="integration radius of all spots (default: radii of the result file)")
+    reintegrate_parser.add_argument("--radius-scale", type=float, default=1.0,
+                    help="factor applied to the integration radii")
+    reintegrate_parser.add_argument("--background", dest="background", action="store_true",
+                    default=None, help="subtract the background")
+    reintegrate_parser.add_argument("--no-background", dest="background", action="store_false",
+                    help="do not subtract the background")
+    reintegrate_parser.add_argument("-j", "--processes", type=int,
+                    help="number of processes (0: number of CPUs, default: config.Tracking_processes)")
+    reintegrate_parser.add_argument("-t", "--text", action="store_true",
+                    help="also write .int and .pos text files")
+    reintegrate_parser.set_defaults(func=reintegration)
+
+    detect_parser = subparsers.add_parser("detect",
+                    help="detect the spots in the first image and write a spots file")
+    detect_parser.add_argument("input", nargs="+",
+                    help="image files and/or directories")
+    detect_parser.add_argument("-o", "--output", required=True,
+                    help="spots file to write (columns x, y, radius, see track -s)")
+    detect_parser.add_argument("-p", "--parameters",
+                    help="parameter file (see the GUI) to use instead of the defaults")
+    detect_parser.add_argument("-f", "--format",
+                    help="image format (default: from file extension)")
+    detect_parser.add_argument("-e", "--energy", type=int,
+                    help="energy of the image (default: lowest energy)")
+    detect_parser.add_argument("--sigma", type=float, nargs="+",
+                    help="widths of the spot filters in pixel (default: config.Detection_sigmas)")
+    detect_parser.add_argument("--min-snr", type=float,
+                    help="minimal signal to background ratio (default: config.Detection_minSignalToBackground)")
+    detect_parser.add_argument("--min-distance", type=float,
+                    help="minimal distance between spots (default: config.Detection_minDistance)")
+    detect_parser.add_argument("-n", "--max-spots", type=int,
+                    help="maximal number of spots, the strongest are kept")
+    detect_parser.set_defaults(func=detect)
+
+    export_parser = subparsers.add_parser("export",
+                    help="convert result files into .int/.pos text files")
+    export_parser.add_argument("input", nargs="+",
+                    help="result files (.res)")
+    export_parser.add_argument("-o", "--output",
+                    help="output prefix or, also for several result files, existing "
+                         "output directory (default: name of the result file)")
+    export_parser.set_defaults(func=export)
+
+    convert_parser = subparsers.add_parser("convert",
+                    help="convert an energy series into one HDF5 image cube")
+    convert_parser.add_argument("input", nargs="+",
+                    help="image files or directories containing image files")
+    convert_parser.add_argument("-o", "--output", required=True,
+                    help="name of the cube file (.h5)")
+    convert_parser.add_argument("-f", "--format",
+                    help="image format of the input files")
+    convert_parser.add_argument("-c", "--compression", choices=["gzip", "lzf"],
+                    help="compress the cube (not memory-mappable then)")
+    convert_parser.add_argument("--chunks",
+                    help="chunk shape y,x within an image (default: whole images)")
+    convert_parser.add_argument("--prefetch", type=int,
+                    help="number of images read ahead (default: config.IO_prefetch)")
+    convert_parser.set_defaults(func=convert)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=config.loggingLevel)
+    try:
+        args.func(args)
+    except IOError, err:
+        parser.exit(1, "IOError: %s\n" % err)
+
+if __name__ == "__main__":
+    main()
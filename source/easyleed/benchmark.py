@@ -0,0 +1,229 @@
+"""
+easyleed.benchmark
+------------------
+
+Benchmarks of the tracking on synthetic images from test.ImageGenerator
+(seeded, so every run sees the same images).
+
+Every scenario (image size, number of spots, spot size, number of
+energies) is timed per stage (generating the images, tracking, integration
+and writing the results, with the stages within the tracking from
+timing.timers) and the throughput and accuracy are stored in a
+JSON file, which can serve as baseline for later runs::
+
+    python -m easyleed.benchmark -o baseline.json
+    python -m easyleed.benchmark -o new.json -b baseline.json
+
+"""
+
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import logging
+import argparse
+from functools import partial
+
+import numpy as np
+
+from . import config
+from .base import tracking_integrator, logger, status_counts
+from .batch import TrackingEngine, config_values
+from .io import ResultWriter
+from .timing import timers
+from .diagnostics import diagnostics
+from .test import (ImageGenerator, Background, back_uniform, lattice_spots,
+                   random_iv_curve, compute_bias, compute_stddev)
+
+""" Parameters of the default scenario, each one is varied in a sweep. """
+DEFAULT_SCENARIO = dict(size=400, spots=16, sigma=2.0, energies=40)
+
+""" Values of the sweeps over one parameter of DEFAULT_SCENARIO. """
+SWEEPS = dict(size=[200, 400, 800],
+              spots=[4, 16, 64],
+              sigma=[1.5, 2.0, 3.0],
+              energies=[20, 40, 80])
+
+""" Smaller sweeps for a quick check. """
+QUICK_SWEEPS = dict(size=[200, 400], spots=[4, 16], sigma=[2.0], energies=[20])
+
+""" Scale of the peak heights of the spots (counts), the integrated intensities
+scale with sigma**2, so that spots of all sizes stay well above the noise. """
+SPOT_HEIGHT = 400
+""" Mean background level (counts per pixel). """
+BACKGROUND_LEVEL = 4
+
+def scenario_name(parameters):
+    return "size%(size)d-spots%(spots)d-sigma%(sigma)g-energies%(energies)d" % parameters
+
+def scenarios(sweeps=None):
+    """ Returns the parameter dictionaries of all scenarios of the sweeps
+    (without duplicates). """
+    if sweeps is None:
+        sweeps = SWEEPS
+    result = []
+    for name in sorted(sweeps):
+        for value in sweeps[name]:
+            parameters = dict(DEFAULT_SCENARIO)
+            parameters[name] = value
+            if parameters not in result:
+                result.append(parameters)
+    return result
+
+def make_generator(size, spots, sigma, energies, seed=0):
+    """ Returns a seeded ImageGenerator (spots with random I(E)-curves on a
+    jittered grid, Poisson noise) and the tracking radius. """
+    random = np.random.RandomState(seed)
+    energy_list = range(60, 60 + energies)
+    radius = max(3 * sigma, 4)
+    spot_list = lattice_spots(size, spots, energy_list, random, sigma=sigma, radius=radius,
+            intensity_func=lambda energies, random: random_iv_curve(energies, random,
+                                                                   SPOT_HEIGHT * 2 * np.pi * sigma**2))
+    background = Background(partial(back_uniform, level=BACKGROUND_LEVEL), (size, size), True)
+    return ImageGenerator(energies=energy_list, spots=spot_list, background=background,
+                          seed=seed, noise="poisson", dtype=np.uint16), radius
+
+def run_scenario(parameters, repeat=1):
+    """ Runs one scenario and returns its times, throughput and accuracy.
+
+    repeat: number of runs, the fastest one is reported
+    """
+    best = None
+    for i in range(repeat):
+        times = {}
+        generator, radius = make_generator(**parameters)
+        start = time.time()
+        images = list(generator)
+        times["generate"] = time.time() - start
+
+        energy = generator.energies[0]
+        seeds = [spot.compute_position(energy) + (radius,) for spot in generator.spots]
+        engine = TrackingEngine(seeds, energy, len(images))
+        start = time.time()
+        engine.run(images)
+        times["track"] = time.time() - start
+        # stages within the tracking (see timing.timers)
+        stages = dict((name, stats["total"]) for name, stats in timers.statistics().iteritems())
+        events = diagnostics.counts.copy()
+
+        results = engine.results
+        start = time.time()
+        for column, (npimage, energy) in enumerate(images):
+            tracking_integrator().intensities(npimage, results.x[:, column], results.y[:, column],
+                    results.radius[:, column],
+                    background_substraction=config.Processing_backgroundSubstractionOn)
+        times["integrate"] = time.time() - start
+
+        handle, filename = tempfile.mkstemp(suffix=".res")
+        os.close(handle)
+        start = time.time()
+        writer = ResultWriter(filename, seeds)
+        for column in range(len(results)):
+            writer.append(zip(results.x[:, column], results.y[:, column],
+                              results.intensity[:, column],
+                              [results.energy[column]] * len(seeds),
+                              results.radius[:, column]), results.status[:, column])
+        writer.close()
+        times["store"] = time.time() - start
+        os.remove(filename)
+        if best is None or times["track"] < best[0]["track"]:
+            best = times, stages, events, generator, results
+
+    times, stages, events, generator, results = best
+    true_x, true_y = np.array([[spot.compute_position(energy) for energy in results.energy]
+                               for spot in generator.spots]).transpose(2, 0, 1)
+    true_intensity = np.array([[spot.intensity_func(energy) for energy in results.energy]
+                               for spot in generator.spots])
+    xs = zip(results.x.ravel(), true_x.ravel())
+    ys = zip(results.y.ravel(), true_y.ravel())
+    # intensity errors relative to the true intensity
+    intensities = zip((results.intensity / true_intensity).ravel(), [1.0] * true_intensity.size)
+    n_images = len(results)
+    n_fits = n_images * results.x.shape[0]
+    return dict(name = scenario_name(parameters), parameters = parameters,
+        times = times, stages = stages,
+        throughput = dict(frames_per_second = n_images / times["track"],
+                          fits_per_second = n_fits / times["track"]),
+        accuracy = dict(position_bias = (compute_bias(xs)**2 + compute_bias(ys)**2)**0.5,
+                        position_sigma = (compute_stddev(xs)**2 + compute_stddev(ys)**2)**0.5,
+                        intensity_bias = compute_bias(intensities),
+                        intensity_sigma = compute_stddev(intensities),
+                        lost_fraction = 1 - status_counts(results.status)["found"] / results.status.size),
+        events = events)
+
+def run(sweeps=None, repeat=1):
+    """ Runs all scenarios and returns the report as a dictionary. """
+    report = dict(created = time.strftime("%Y-%m-%d %H:%M:%S"),
+                  environment = dict(python = platform.python_version(),
+                                     numpy = np.__version__,
+                                     machine = platform.machine(),
+                                     processor = platform.processor()),
+                  config = dict((name, repr(value)) for name, value in config_values().iteritems()),
+                  scenarios = [])
+    for parameters in scenarios(sweeps):
+        result = run_scenario(parameters, repeat)
+        logger.info("%s: %.1f frames/s, %.0f fits/s, position sigma %.3f" % (result["name"],
+                    result["throughput"]["frames_per_second"],
+                    result["throughput"]["fits_per_second"],
+                    result["accuracy"]["position_sigma"]))
+        report["scenarios"].append(result)
+    return report
+
+def compare(report, baseline, tolerance=0.2):
+    """ Compares a report with a baseline report.
+
+    Returns a list of messages for the scenarios whose throughput dropped
+    or whose position or intensity error grew by more than tolerance
+    (relative).
+    """
+    old = dict((scenario["name"], scenario) for scenario in baseline["scenarios"])
+    regressions = []
+    for scenario in report["scenarios"]:
+        reference = old.get(scenario["name"])
+        if reference is None:
+            continue
+        for key, value in scenario["throughput"].iteritems():
+            if value < (1 - tolerance) * reference["throughput"][key]:
+                regressions.append("%s: %s dropped from %.4g to %.4g" % (scenario["name"],
+                                   key, reference["throughput"][key], value))
+        for key in ("position_sigma", "intensity_sigma"):
+            value, before = scenario["accuracy"][key], reference["accuracy"][key]
+            # small absolute changes of small errors are noise
+            if value > (1 + tolerance) * before + 1e-3:
+                regressions.append("%s: %s grew from %.4g to %.4g" % (scenario["name"],
+                                   key, before, value))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="easyleed-benchmark",
+                    description="Benchmark the tracking on synthetic images.")
+    parser.add_argument("-o", "--output", default="benchmark.json",
+                    help="file the report is written to (JSON)")
+    parser.add_argument("-b", "--baseline",
+                    help="report of an earlier run to compare with")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2,
+                    help="relative change reported as regression (default: 0.2)")
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                    help="runs per scenario, the fastest is reported")
+    parser.add_argument("--quick", action="store_true",
+                    help="run a smaller set of scenarios")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.INFO)
+    report = run(QUICK_SWEEPS if args.quick else SWEEPS, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for message in regressions:
+            logger.warning("regression: " + message)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+easyleed.curves
+---------------
+
+Aggregation of I(E)-curves (no PyQt4 needed).
+
+All functions work on intensity arrays of shape (n_beams, n_energies) as
+stored in a ResultStore or ResultFile.
+
+"""
+
+import numpy as np
+
+""" Available normalizations (see normalize). """
+NORMALIZATIONS = ["max", "area", "reference"]
+
+def beam_curves(results, beams=None):
+    """ Returns the energies and the intensities of the selected beams.
+
+    results: ResultStore or ResultFile
+    beams: indices of the beams (default: all)
+    """
+    intensity = results.intensity
+    if beams is not None:
+        intensity = intensity[np.asarray(beams, dtype=int)]
+    return np.asarray(results.energy), np.asarray(intensity)
+
+def average(intensity, weights=None):
+    """ Returns the (weighted) average curve of all beams, ignoring NaN values.
+
+    weights: one weight per beam (default: equal weights)
+    """
+    intensity = np.asarray(intensity, dtype=float).reshape(-1, np.shape(intensity)[-1])
+    if weights is None:
+        weights = np.ones(len(intensity))
+    weights = np.asarray(weights, dtype=float)[:, np.newaxis] * ~np.isnan(intensity)
+    total = weights.sum(axis=0)
+    weighted = np.where(weights > 0, intensity, 0) * weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return weighted.sum(axis=0) / total
+
+def group_average(intensity, groups):
+    """ Returns the average curve of every group of (symmetry equivalent) beams.
+
+    groups: list of lists of beam indices
+    """
+    intensity = np.asarray(intensity, dtype=float)
+    return np.array([average(intensity[list(group)]) for group in groups])
+
+def normalize(intensity, method="max", energy=None, reference=None):
+    """ Normalizes every beam.
+
+    method: "max" (maximum 1), "area" (integral over energy 1, needs energy)
+            or "reference" (divided by reference, e.g. the beam current)
+    energy: energies of the columns
+    reference: one value per energy
+    """
+    intensity = np.asarray(intensity, dtype=float)
+    if method == "max":
+        norm = np.nanmax(np.abs(intensity), axis=-1)[..., np.newaxis]
+    elif method == "area":
+        if energy is None:
+            raise ValueError("Normalization by area needs the energies.")
+        norm = np.trapz(np.nan_to_num(intensity), np.asarray(energy, dtype=float),
+                        axis=-1)[..., np.newaxis]
+    elif method == "reference":
+        if reference is None:
+            raise ValueError("Normalization by reference needs the reference values.")
+        norm = np.asarray(reference, dtype=float)
+    else:
+        raise ValueError("Unknown normalization %s (%s)." % (method, ", ".join(NORMALIZATIONS)))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return intensity / norm
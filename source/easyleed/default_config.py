@@ -11,6 +11,27 @@ import numpy as np
 # regular expression to extract energy from filename (not used for img files)
 # match between two and three decimal numbers, then lookaround 
 IO_energyRegex = "\d{2,3}(?=\.)"
+# keep energies and header information of the images in an index file
+IO_useIndex = False
+# directory of the index files, one per image directory
+# (None: easyleed/index in the user's cache directory, e.g. ~/.cache)
+IO_indexDirectory = None
+# also store minimum and maximum of every image in the index (reads all images)
+IO_indexStatistics = False
+# number of threads scanning images missing in the index
+IO_indexThreads = 8
+# size of the cache for decoded images in bytes (0: off)
+IO_cacheSize = 512 * 2**20
+# map .img files into memory instead of reading them completely
+IO_memoryMap = True
+# force result files to disk after every energy (slower, survives power loss)
+IO_resultsSync = False
+# number of images between checkpoints of command line runs (0: off)
+IO_checkpointInterval = 50
+# number of images read ahead in background threads (0: off)
+IO_prefetch = 0
+# maximal number of threads reading images ahead
+IO_prefetchThreads = 4
 
 ####################
 ####################
@@ -18,6 +39,16 @@ IO_energyRegex = "\d{2,3}(?=\.)"
 #### GUI related ####
 #####################
 
+## Display ##
+# percentiles of the pixel values shown as black and white
+Display_percentiles = (0.5, 99.5)
+# number of pixels sampled to determine the contrast limits
+Display_samples = 2**16
+
+## MainWindow ##
+# maximal number of display updates per second while tracking
+MainWindow_refreshRate = 10
+
 ## GraphicsScene ##
 # default radius of a new spot
 GraphicsScene_defaultRadius = 10
@@ -42,8 +73,15 @@ Tracking_inputPrecision = 10
 Tracking_windowScalingOn = True
 # minimum radius of the integration window (in pixel)
 Tracking_minWindowSize = 0
-# function for spot identification
+# function for spot identification (see base.GUESS_FUNCS)
 Tracking_guessFunc = "guess_from_Gaussian"
+# fit all spots of an image at once with a vectorized Gaussian fit
+# (used by TrackerBank instead of Tracking_guessFunc)
+Tracking_batchFittingOn = False
+# number of processes tracking the spots in parallel (None or 0: number of CPUs)
+Tracking_processes = 1
+# minimal number of spots per process (otherwise less processes are used)
+Tracking_parallelMinSpots = 32
 # Kalman tracker process noise
 Tracking_processNoise = np.diag([4e-2, 4e-2, 0, 0])
 # size of validation region
@@ -52,12 +90,56 @@ Tracking_processNoise = np.diag([4e-2, 4e-2, 0, 0])
 Tracking_gamma = 8
 # Minimal coefficient of determination R^2 for fit
 Tracking_minRsq = 0.8
+# place the fit windows by the common movement of all spots (center and
+# scale of the pattern) and update lost spots with it (serial tracking only)
+Tracking_latticeOn = False
+# minimal number of found spots to fit the common movement
+Tracking_latticeMinSpots = 3
+# minimal uncertainty of the positions of lost spots placed by the lattice (in pixel)
+Tracking_latticeMinSigma = 0.1
 
 ##########################
 ##########################
 
+#### Detection related ####
+###########################
+
+# widths (sigma in pixel) of the Laplacian of Gaussian filters finding the spots
+Detection_sigmas = [1.5, 2, 3, 4]
+# minimal filter response of a spot in units of the noise of the response
+Detection_minResponse = 5
+# minimal signal to background ratio of a spot (see base.signal_to_background)
+Detection_minSignalToBackground = 1.5
+# minimal distance between two spots (in pixel)
+Detection_minDistance = 5
+# radius of a spot in units of the width of the filter it was found with
+Detection_radiusFactor = 3
+# maximal number of spots, the strongest are kept (None: no limit)
+Detection_maxSpots = None
+# width of the image border without spots (in pixel)
+Detection_border = 2
+
+###########################
+###########################
+
 #### Processing related ####
 ############################
 
 # substract the background from the intensity measurements
 Processing_backgroundSubstractionOn = True
+# number of sub-pixel bins per pixel for cached integration stencils of the
+# trackers, e.g. 20 (faster with many spots, but the spot center is rounded
+# by at most 0.5 / bins pixel, so the intensities change slightly;
+# 0 or None: exact integration)
+Processing_stencilBins = 0
+# number of radius steps per pixel for the cached integration stencils
+# (the radius is rounded by at most 0.5 / steps pixel, 0 or None: exact radius,
+# which makes the cache useless with Tracking_windowScalingOn)
+Processing_stencilRadiusBins = 4
+# maximal number of cached integration stencils
+Processing_stencilCacheSize = 1024
+# measure the time spent in the processing stages (see timing.timers)
+Processing_timersOn = True
+# minimal time between log messages about the same tracking event in
+# seconds (see diagnostics.diagnostics)
+Processing_diagnosticsInterval = 10
@@ -0,0 +1,119 @@
+"""
+easyleed.detection
+------------------
+
+Automatic detection of spots to seed the tracking (no PyQt4 needed).
+
+The image is filtered with scale-normalized Laplacian of Gaussian (LoG)
+filters of several widths, which removes a smooth background. Local
+maxima of the strongest response above a noise threshold are candidates,
+which are kept if their signal to background ratio is high enough and no
+stronger spot is closer than the minimal distance. The detected spots
+(x, y, radius) can be used directly as start positions of a TrackerBank::
+
+    spots = detect_spots(npimage)
+
+"""
+
+import numpy as np
+from scipy import ndimage
+
+from . import config
+from .base import exact_integrator
+
+def log_responses(npimage, sigmas):
+    """ Returns the scale-normalized LoG responses (bright spots positive)
+    of the image as an array of shape (len(sigmas),) + npimage.shape. """
+    image = np.asarray(npimage, dtype=float)
+    return np.array([-sigma**2 * ndimage.gaussian_laplace(image, sigma) for sigma in sigmas])
+
+def noise_level(values):
+    """ Returns a robust estimate of the standard deviation (from the
+    median absolute deviation). """
+    values = np.ravel(values)
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+def refine_peaks(response, rows, columns):
+    """ Returns the sub-pixel positions of maxima of response from
+    parabolas through the neighbouring pixels. """
+    height, width = response.shape
+    def offset(before, center, after):
+        curvature = before - 2 * center + after
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = 0.5 * (before - after) / curvature
+        return np.where(curvature < 0, np.clip(delta, -0.5, 0.5), 0)
+    y = rows + offset(response[np.maximum(rows - 1, 0), columns], response[rows, columns],
+                      response[np.minimum(rows + 1, height - 1), columns])
+    x = columns + offset(response[rows, np.maximum(columns - 1, 0)], response[rows, columns],
+                         response[rows, np.minimum(columns + 1, width - 1)])
+    return x, y
+
+def suppress_neighbours(x, y, min_distance):
+    """ Returns the indices of the spots kept if spots (ordered by
+    decreasing strength) closer than min_distance to a stronger spot
+    are dropped. """
+    kept = []
+    for i in range(len(x)):
+        if kept and (np.hypot(x[kept] - x[i], y[kept] - y[i]) < min_distance).any():
+            continue
+        kept.append(i)
+    return np.array(kept, dtype=int)
+
+def detect_spots(npimage, sigmas=None, min_response=None, min_snr=None, min_distance=None,
+                 radius_factor=None, max_spots=None, border=None):
+    """ Finds the spots in an image.
+
+    sigmas: widths of the LoG filters (default: config.Detection_sigmas)
+    min_response: minimal LoG response in units of its noise level
+                  (default: config.Detection_minResponse)
+    min_snr: minimal signal to background ratio (see base.signal_to_background,
+             default: config.Detection_minSignalToBackground)
+    min_distance: minimal distance between spots in pixel
+                  (default: config.Detection_minDistance)
+    radius_factor: radius of a spot in units of the width of its strongest
+                   LoG filter (default: config.Detection_radiusFactor)
+    max_spots: maximal number of spots, the strongest are kept
+               (default: config.Detection_maxSpots, None: no limit)
+    border: width of the image border without spots in pixel
+            (default: config.Detection_border)
+
+    Returns a list of (x, y, radius), strongest spots first.
+    """
+    if sigmas is None:
+        sigmas = config.Detection_sigmas
+    if min_response is None:
+        min_response = config.Detection_minResponse
+    if min_snr is None:
+        min_snr = config.Detection_minSignalToBackground
+    if min_distance is None:
+        min_distance = config.Detection_minDistance
+    if radius_factor is None:
+        radius_factor = config.Detection_radiusFactor
+    if max_spots is None:
+        max_spots = config.Detection_maxSpots
+    if border is None:
+        border = config.Detection_border
+    sigmas = np.atleast_1d(np.asarray(sigmas, dtype=float))
+
+    responses = log_responses(npimage, sigmas)
+    scale = responses.argmax(axis=0)
+    response = responses.max(axis=0)
+    # local maxima (non-maximum suppression) above the noise threshold
+    size = 2 * int(np.ceil(min_distance)) + 1
+    peaks = response == ndimage.maximum_filter(response, size=size, mode="nearest")
+    peaks &= response > max(min_response * noise_level(response), 0)
+    if border > 0:
+        peaks[:border] = peaks[-border:] = False
+        peaks[:, :border] = peaks[:, -border:] = False
+    rows, columns = np.nonzero(peaks)
+    order = np.argsort(-response[rows, columns], kind="mergesort")
+    rows, columns = rows[order], columns[order]
+
+    x, y = refine_peaks(response, rows, columns)
+    radius = radius_factor * sigmas[scale[rows, columns]]
+    snr = exact_integrator.signals_to_background(npimage, x, y, radius)
+    strong = np.flatnonzero(snr >= min_snr)
+    strong = strong[suppress_neighbours(x[strong], y[strong], min_distance)]
+    if max_spots is not None:
+        strong = strong[:max_spots]
+    return [(x[i], y[i], radius[i]) for i in strong]
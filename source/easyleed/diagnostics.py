@@ -0,0 +1,83 @@
+"""
+easyleed.diagnostics
+--------------------
+
+Counted events of the tracking (e.g. failed fits) with rate-limited logging.
+
+Instead of printing a message for every spot and energy, the tracking
+reports events to the module wide Diagnostics instance::
+
+    diagnostics.event("fit_failed")
+
+Every event is counted until reset() is called (the tracking engines reset
+the counters at the start of every run and log a summary at the end), but
+at most one log message per event and config.Processing_diagnosticsInterval
+seconds is written.
+
+"""
+
+import time
+import logging
+
+from . import config
+
+logger = logging.getLogger("leedbase")
+
+""" Descriptions of the events. """
+EVENTS = {"gated": "spot outside the validation gate",
+          "fit_failed": "fit failed",
+          "low_rsq": "R^2 of the fit too low",
+          "clipped_window": "window clipped at the image border",
+          "outside_image": "position outside image"}
+
+class Diagnostics(object):
+    """ Counts named events and logs them at a limited rate.
+
+    counts: dictionary with the number of every event since the last reset
+    """
+
+    def __init__(self):
+        self.counts = {}
+        # events not logged yet and time of the last message, by name
+        self._pending = {}
+        self._logged = {}
+
+    def event(self, name, count=1):
+        """ Records count occurrences of the event name. """
+        self.counts[name] = self.counts.get(name, 0) + count
+        self._pending[name] = self._pending.get(name, 0) + count
+        now = time.time()
+        if now - self._logged.get(name, 0) >= config.Processing_diagnosticsInterval:
+            self._logged[name] = now
+            self._log(name)
+
+    def _log(self, name):
+        count = self._pending.pop(name, 0)
+        description = EVENTS.get(name, name)
+        if count > 1:
+            logger.info("%s (%d times since the last message)" % (description, count))
+        elif count:
+            logger.info(description)
+
+    def merge(self, counts):
+        """ Adds the counts of another Diagnostics (e.g. sent from a worker process). """
+        for name, count in counts.iteritems():
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def reset(self):
+        self.counts = {}
+        self._pending = {}
+        self._logged = {}
+
+    def summary(self):
+        """ Returns a one line summary of the counts, e.g. "fit failed: 3". """
+        return ", ".join("%s: %d" % (EVENTS.get(name, name), self.counts[name])
+                         for name in sorted(self.counts))
+
+    def log_summary(self, level=logging.INFO):
+        self._pending = {}
+        if self.counts:
+            logger.log(level, "tracking events: " + self.summary())
+
+""" Diagnostics used by all modules. """
+diagnostics = Diagnostics()
@@ -1,18 +1,24 @@
 import sys
+import time
 import logging
 
-from PyQt4.QtCore import (QPoint, QRectF, QPointF, Qt, SIGNAL, QTimer, QObject)
+from PyQt4.QtCore import (QPoint, QRectF, QPointF, Qt, SIGNAL, QTimer, QObject, QThread)
 from PyQt4.QtGui import (QApplication, QMainWindow, QGraphicsView,
     QGraphicsScene, QImage, QWidget, QHBoxLayout, QPen,
     QVBoxLayout, QPushButton, QGraphicsEllipseItem, QGraphicsItem,
     QPainter, QKeySequence, QAction, QIcon, QFileDialog, QProgressBar,
-    QBrush, QFrame, QLabel, QRadioButton, QGridLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QComboBox, QLineEdit, QMessageBox)
+    QBrush, QFrame, QLabel, QRadioButton, QGridLayout, QSpinBox, QDoubleSpinBox, QCheckBox, QComboBox, QLineEdit, QMessageBox, qRgb)
 import numpy as np
 
 from . import config
 from . import __version__
 from base import *
 from io import *
+from batch import TrackingEngine
+from timing import timers
+from diagnostics import diagnostics
+from detection import detect_spots
+import curves
 
 ##H #
 import matplotlib
@@ -20,14 +26,31 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QTAgg as NavigationToolbar
 from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
 import pickle
-from . import my_flatten as flt
 #####
 
 
 
 logging.basicConfig(filename = config.loggingFilename, level=config.loggingLevel)
 
+# grayscale color table shared by all displayed images
+GRAY_COLOR_TABLE = [qRgb(i, i, i) for i in range(256)]
+# converts images to uint8 (keeps the lookup table between images)
+display_converter = DisplayConverter()
+
+def npimage2qimage(npimage):
+    """ Converts numpy grayscale image to qimage."""
+    h, w = npimage.shape
+    npimage = np.ascontiguousarray(display_converter(npimage))
+    # second w to avoid problems if image is not 32-bit aligned
+    # --> indicates bytesPerLine
+    qimage = QImage(npimage.data, w, h, w, QImage.Format_Indexed8)
+    qimage.setColorTable(GRAY_COLOR_TABLE)
+    # the QImage does not copy the data, so keep the buffer alive with it
+    qimage.ndarray = npimage
+    return qimage
+
 class QGraphicsSpotView(QGraphicsEllipseItem):
     """ Provides an QGraphicsItem to display a Spot on a QGraphicsScene.
     
@@ -117,7 +140,8 @@ class QGraphicsSpotView(QGraphicsEllipseItem):
 
 class QSpotModel(QObject):
     """
-    Wraps a SpotModel to offer signals.
+    Wraps the results of a spot (a SpotView of the engine's ResultStore,
+    which stores them) to offer signals.
 
     Provides the following signals:
     - intensityChanged
@@ -125,12 +149,12 @@ class QSpotModel(QObject):
     - radiusChanged
     """
 
-    def __init__(self, parent = None):
+    def __init__(self, parent, model):
         super(QSpotModel, self).__init__(parent)
-        self.m = SpotModel()
-    
-    def update(self, x, y, intensity, energy, radius):
-        self.m.update(x, y, intensity, energy, radius)
+        self.m = model
+
+    def notify(self, x, y, intensity, energy, radius):
+        """ Emits the signals without storing the values. """
         QObject.emit(self, SIGNAL("positionChanged"), QPointF(x, y))
         QObject.emit(self, SIGNAL("radiusChanged"), radius)
         QObject.emit(self, SIGNAL("intensityChanged"), intensity)
@@ -246,7 +270,11 @@ class PlotOptionWidget(QWidget):
         self.gridLayout.addLayout(self.hLayout, 1, 0, 1, 1)
 
 class Plot(QWidget):
-    '''Custom PyQt widget canvas for plotting'''
+    '''Custom PyQt widget canvas for plotting
+
+    The beams are drawn as one LineCollection. During a run new points are
+    drawn on top of the last frame and blitted, the whole figure is only
+    redrawn if the data leaves the axes limits.'''
 
     def __init__(self, parent=None):
         QWidget.__init__(self, parent)
@@ -278,6 +306,98 @@ class Plot(QWidget):
         
         self.setLayout(vbox)
 
+        # artists of the curves and number of energies drawn so far
+        self.beams = None
+        self.average = None
+        self.drawn = 0
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self.onDraw)
+
+    def onDraw(self, event):
+        """ Keeps the rendered axes for blitting. """
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+
+    def clear(self):
+        self.axes.cla()
+        self.beams = None
+        self.average = None
+        self.drawn = 0
+        # setting the axe labels
+        self.axes.set_xlabel("Energy [eV]")
+        self.axes.set_ylabel("Intensity")
+        self.axes.set_title("I(E)-curve")
+        # removes the ticks from y-axis
+        self.axes.set_yticks([])
+
+    def plotCurves(self, energy, intensity, beams=True, average=False, energy_range=None):
+        """ Draws the I(E)-curves of all beams and/or their average from scratch.
+
+        energy_range: limits of the energy axis (default: range of energy)
+        """
+        if beams:
+            colors = matplotlib.cm.rainbow(np.linspace(0, 1, max(len(intensity), 1)))
+            self.beams = LineCollection([], colors=colors)
+            self.axes.add_collection(self.beams)
+        if average:
+            self.average, = self.axes.plot([], [], 'k-', linewidth=3, label = 'Average')
+        if energy_range is None and len(energy):
+            energy_range = (energy[0], energy[-1])
+        if energy_range is not None:
+            self.axes.set_xlim(energy_range[0], max(energy_range[1], energy_range[0] + 1))
+        self.updateCurves(energy, intensity, redraw=True)
+
+    def updateCurves(self, energy, intensity, redraw=False):
+        """ Sets the data of the curves, drawing only the points added since the last call. """
+        if self.beams is None and self.average is None:
+            return
+        energy = np.asarray(energy, dtype=float)
+        intensity = np.asarray(intensity, dtype=float).reshape(-1, len(energy))
+        if self.beams is not None:
+            self.beams.set_segments([np.column_stack((energy, row)) for row in intensity])
+        if self.average is not None:
+            average_intensity = curves.average(intensity)
+            self.average.set_data(energy, average_intensity)
+        # the new segments start at the last point drawn
+        start = max(self.drawn - 1, 0)
+        self.drawn = len(energy)
+        new = intensity[:, start:]
+        if self.average is not None:
+            new = np.vstack((new, average_intensity[start:]))
+        if self.extendLimits(new, reset=redraw) or redraw or self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        if self.beams is not None:
+            segments = LineCollection([np.column_stack((energy[start:], row))
+                                       for row in intensity[:, start:]],
+                                      colors=self.beams.get_colors(),
+                                      transform=self.axes.transData)
+            segments.set_figure(self.fig)
+            segments.set_clip_box(self.axes.bbox)
+            self.axes.draw_artist(segments)
+        if self.average is not None:
+            self.axes.draw_artist(self.average)
+        self.canvas.blit(self.axes.bbox)
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+
+    def extendLimits(self, intensity, reset=False):
+        """ Extends the intensity axis to the data (returns whether it changed).
+
+        reset: fit the axis to the data only
+        """
+        if not np.isfinite(intensity).any():
+            return False
+        low, high = np.nanmin(intensity), np.nanmax(intensity)
+        ymin, ymax = self.axes.get_ylim()
+        if not reset and ymin <= low and high <= ymax:
+            return False
+        if reset:
+            ymin, ymax = low, high
+        # leave head room, so that the figure has to be redrawn only rarely
+        span = max(max(high, ymax) - min(low, ymin), abs(high), 1.0)
+        self.axes.set_ylim(min(low, ymin) - 0.1 * span, max(high, ymax) + 0.5 * span)
+        return True
+
 class SetParameters(QWidget): 
     '''PyQt widget for setting tracking parameters'''
  
@@ -317,8 +437,13 @@ class SetParameters(QWidget):
         self.backgroundSubstraction = QCheckBox("Background substraction")
         self.backgroundSubstraction.setChecked(config.Processing_backgroundSubstractionOn)
 
+        self.latticeTracking = QCheckBox("Track the common movement of all spots")
+        self.latticeTracking.setChecked(config.Tracking_latticeOn)
+
         self.spotIdentification = QComboBox(self)
-        self.spotIdentification.addItem("guess_from_Gaussian")
+        for name in sorted(GUESS_FUNCS):
+            self.spotIdentification.addItem(name)
+        self.spotIdentification.setCurrentIndex(self.spotIdentification.findText(config.Tracking_guessFunc))
         self.siLabel = QLabel("Spot indentification algorithm", self)
 
 
@@ -366,6 +491,7 @@ class SetParameters(QWidget):
         self.rvLayout = QVBoxLayout()
         self.rvLayout.addWidget(self.integrationWindowScale)
         self.rvLayout.addWidget(self.backgroundSubstraction)
+        self.rvLayout.addWidget(self.latticeTracking)
         self.rvLayout.addWidget(self.siLabel)
         self.rvLayout.addWidget(self.spotIdentification)
 
@@ -438,10 +564,11 @@ class MainWindow(QMainWindow):
         #processSpotsAction = self.createAction("&Process Spots", self.processSpots, QKeySequence("Ctrl+"), None, "Process spots.")
         processPlotOptions = self.createAction("&Plot...", self.plottingOptions, None, None, "Choose plotting method.")
         processSetParameters = self.createAction("&Set Parameters", self.setParameters, None, None, "Set tracking parameters.")
+        processDetectAction = self.createAction("&Detect spots", self.detectSpots, QKeySequence("Ctrl+k"), None, "Detect the spots in the current image.")
 
 ######
 
-        self.processActions = [processNextAction, processPreviousAction, None, processRunAction, processRestartAction, None, processPlotAction, None, processPlotAverageAction, None, processSetParameters]
+        self.processActions = [processNextAction, processPreviousAction, None, processDetectAction, processRunAction, processRestartAction, None, processPlotAction, None, processPlotAverageAction, None, processSetParameters]
         fileOpenAction = self.createAction("&Open...", self.fileOpen,
                 QKeySequence.Open, None,
                 "Open a directory containing the image files.")
@@ -488,6 +615,9 @@ class MainWindow(QMainWindow):
         self.energyLabel = QLabel()
         self.energyLabel.setFrameStyle(QFrame.StyledPanel | QFrame.Sunken)
         self.statusBar().addPermanentWidget(self.energyLabel)
+
+        # background thread running the tracking (see run)
+        self.trackingThread = None
   
     def addActions(self, target, actions):
         """
@@ -544,7 +674,7 @@ class MainWindow(QMainWindow):
         self.scene.removeAll()
         self.loader.restart()
         self.setImage(self.loader.next())
-        self.plotwid.axes.cla()
+        self.plotwid.clear()
         self.plotwid.canvas.draw()
         self.plotwid.close()
 
@@ -553,6 +683,7 @@ class MainWindow(QMainWindow):
         qimage = npimage2qimage(npimage)
         self.view.setSceneRect(QRectF(qimage.rect()))
         self.scene.setBackground(qimage)
+        self.current_image = npimage
         self.current_energy = energy
         self.energyLabel.setText("Energy %s eV" % self.current_energy)
 
@@ -571,7 +702,8 @@ class MainWindow(QMainWindow):
             filetype = IMAGE_FORMATS[str(dialog.selectedNameFilter())]
             files = [str(file_) for file_ in files]
             try:
-                self.loader = filetype.loader(files, config.IO_energyRegex)
+                self.loader = filetype.loader(files, config.IO_energyRegex, prefetch=config.IO_prefetch,
+                                              use_index=config.IO_useIndex, cache_size=config.IO_cacheSize)
                 self.setImage(self.loader.next())
                 self.enableProcessActions(True)
             except IOError, err:
@@ -579,40 +711,63 @@ class MainWindow(QMainWindow):
             
     def stopProcessing(self):
         self.stopped = True
+        if self.trackingThread is not None:
+            self.trackingThread.stop()
 
     def run(self):
-        import time
-        time_before = time.time()
+        self.time_before = time.time()
         
         self.stopped = False
-        progress = QProgressBar()
+        self.progress = QProgressBar()
         stop = QPushButton("Stop", self)
         self.connect(stop, SIGNAL("clicked()"), self.stopProcessing)
-        progress.setMinimum(int(self.loader.current_energy()))
-        progress.setMaximum(int(self.loader.energies[-1]))
+        self.progress.setMinimum(int(self.loader.current_energy()))
+        self.progress.setMaximum(int(self.loader.energies[-1]))
         statusLayout = QHBoxLayout()
-        statusLayout.addWidget(progress)
+        statusLayout.addWidget(self.progress)
         statusLayout.addWidget(stop)
-        statusWidget = QWidget(self)
-        statusWidget.setLayout(statusLayout)
-        self.statusBar().addWidget(statusWidget)
+        self.statusWidget = QWidget(self)
+        self.statusWidget.setLayout(statusLayout)
+        self.statusBar().addWidget(self.statusWidget)
         self.view.setInteractive(False)
         self.scene.clearSelection()
-        self.worker = Worker(self.scene.items(), self.current_energy, parent=self)
+        self.worker = Worker(self.scene.items(), self.current_energy,
+                n_energies=len(self.loader.energies) - self.loader.index - 1, parent=self)
         self.fileSaveAction.setEnabled(True)
         self.fileSaveSpotsAction.setEnabled(True)
-        for image in self.loader:
-            if self.stopped:
-                break
-            progress.setValue(int(image[1]))
-            QApplication.processEvents()
+        if self.plotwid.isVisible():
+            # follow the new run in the open plot
+            self.showPlot(self.plotwid.beams is not None, self.plotwid.average is not None)
+        # the loader belongs to the tracking thread until it has finished
+        self.enableProcessActions(False)
+        self.trackingThread = TrackingThread(self.worker.engine, self.loader, self)
+        self.connect(self.trackingThread, SIGNAL("progress"), self.showProgress)
+        self.connect(self.trackingThread, SIGNAL("finished()"), self.runFinished)
+        self.trackingThread.start()
+
+    def showProgress(self, image, results):
+        """ Shows the latest image and spot positions of a running tracking. """
+        self.progress.setValue(int(image[1]))
+        with timers("display"):
             self.setImage(image)
-            self.worker.process(image)
-            QApplication.processEvents()
+            self.worker.notify(results)
+        if self.plotwid.isVisible():
+            # add the energies tracked since the last update to the plot
+            store = self.worker.engine.results
+            count = len(store)
+            self.plotwid.updateCurves(store.energy[:count], store.intensity[:, :count])
+
+    def runFinished(self):
+        """ Cleans up after the tracking thread has finished. """
+        if self.trackingThread.error is not None:
+            self.statusBar().showMessage("Tracking failed: %s" % self.trackingThread.error, 5000)
+        elif diagnostics.counts:
+            self.statusBar().showMessage("Tracking finished (%s)" % diagnostics.summary(), 10000)
+        self.trackingThread = None
         self.view.setInteractive(True)
-        self.statusBar().removeWidget(statusWidget)
-
-        print time.time() - time_before
+        self.statusBar().removeWidget(self.statusWidget)
+        self.enableProcessActions(True)
+        logger.info("tracking took %.2f s" % (time.time() - self.time_before))
 
     def disableInput(self):
         for item in self.scene.items():
@@ -635,60 +790,29 @@ class MainWindow(QMainWindow):
 
     def plotting(self):
         '''Basic Matplotlib plotting I(E)-curve'''
-        # do only if there's some data to draw the plot from, otherwise show an error message in the statusbar
-        try:
-            # getting intensities and energy from the worker class
-            intensities = [model.m.intensity for model, tracker \
-                                in self.worker.spots_map.itervalues()]
-            energy = [model.m.energy for model, tracker in self.worker.spots_map.itervalues()]
-            # setting the axe labels
-            self.plotwid.axes.set_xlabel("Energy [eV]")
-            self.plotwid.axes.set_ylabel("Intensity")
-            self.plotwid.axes.set_title("I(E)-curve")
-            # removes the ticks from y-axis
-            self.plotwid.axes.set_yticks([])
-
-            # do the plot
-            for x in energy:
-                for y in intensities:
-                    self.plotwid.axes.plot(x, y)
-            # and show it
-            self.plotwid.canvas.draw()
-            self.plotwid.show()
-            # can save the plot now
-            self.fileSavePlotAction.setEnabled(True)
-        except AttributeError:
-            self.statusBar().showMessage("No plottable data.", 5000)
+        self.showPlot(beams=True, average=False)
 
     def plottingAverage(self):
         '''Mostly the same as normal plotting but plots the average of the calculated intensities '''
+        self.showPlot(beams=False, average=True)
+
+    def showPlot(self, beams, average):
+        '''Plots the I(E)-curves of all beams and/or their average'''
+        # do only if there's some data to draw the plot from, otherwise show an error message in the statusbar
         try:
-            sum_intensity=0
-            list_of_average_intensities = []
-            intensities = [model.m.intensity for model, tracker \
-                                in self.worker.spots_map.itervalues()]
-            number_of_pictures = len(intensities[0])
-            number_of_points = len(intensities)
-            energy = [model.m.energy for model, tracker in self.worker.spots_map.itervalues()]
-            intensities = flt.flatten(intensities)
-            for i in range(number_of_pictures):
-                for j in range(i, len(intensities), number_of_pictures):
-                    sum_intensity = sum_intensity + intensities[j]
-                average_intensity = sum_intensity/number_of_points
-                list_of_average_intensities.append(average_intensity)
-                sum_intensity = 0
-            # setting the axe labels
-            self.plotwid.axes.set_xlabel("Energy [eV]")
-            self.plotwid.axes.set_ylabel("Intensity")
-            self.plotwid.axes.set_title("I(E)-curve")
-            # removes the ticks from y-axis
-            self.plotwid.axes.set_yticks([])
-            self.plotwid.axes.plot(energy[0], list_of_average_intensities,'k-', linewidth=3, label = 'Average')
-            self.plotwid.canvas.draw()
-            self.plotwid.show()
-            self.fileSavePlotAction.setEnabled(True)
+            results = self.worker.engine.results
         except AttributeError:
             self.statusBar().showMessage("No plottable data.", 5000)
+            return
+        # read the count once, the tracking thread may be adding energies
+        count = len(results)
+        self.plotwid.clear()
+        self.plotwid.plotCurves(results.energy[:count], results.intensity[:, :count],
+                beams = beams, average = average,
+                energy_range = (self.loader.energies[0], self.loader.energies[-1]))
+        self.plotwid.show()
+        # can save the plot now
+        self.fileSavePlotAction.setEnabled(True)
 
     def plottingOptions(self):
 
@@ -699,17 +823,13 @@ class MainWindow(QMainWindow):
 
     def PlotWidgetAccept(self):        
         if self.plotoptionwid.rbutton1.isChecked():
-            self.plotwid.axes.cla()
             self.plotting()
             self.plotoptionwid.close()
         elif self.plotoptionwid.rbutton2.isChecked():
-            self.plotwid.axes.cla()
             self.plottingAverage()
             self.plotoptionwid.close()
         elif self.plotoptionwid.rbutton3.isChecked():
-            self.plotwid.axes.cla()
-            self.plotting()
-            self.plottingAverage()
+            self.showPlot(beams=True, average=True)
             self.plotoptionwid.close()
         else:
             self.plotoptionwid.label.setText('Check a mode')
@@ -730,10 +850,11 @@ class MainWindow(QMainWindow):
         config.Tracking_inputPrecision = self.setparameterswid.inputPrecision.value()
         config.Tracking_windowScalingOn = self.setparameterswid.integrationWindowScale.isChecked()
         config.Tracking_minWindowSize = self.setparameterswid.integrationWindowRadius.value()
-        config.Tracking_guessFunc = self.setparameterswid.spotIdentification.currentText()
+        config.Tracking_guessFunc = str(self.setparameterswid.spotIdentification.currentText())
         config.Tracking_gamma = self.setparameterswid.validationRegionSize.value()
         config.Tracking_minRsq = self.setparameterswid.determinationCoefficient.value()
         config.Processing_backgroundSubstractionOn = self.setparameterswid.backgroundSubstraction.isChecked()
+        config.Tracking_latticeOn = self.setparameterswid.latticeTracking.isChecked()
         try:
             self.noiseList = [float(self.setparameterswid.value1.text()), float(self.setparameterswid.value2.text()), float(self.setparameterswid.value3.text()), float(self.setparameterswid.value4.text())]
             config.Tracking_processNoise = np.diag(self.noiseList)
@@ -751,6 +872,7 @@ class MainWindow(QMainWindow):
         self.setparameterswid.determinationCoefficient.setValue(config.Tracking_minRsq)
         self.setparameterswid.integrationWindowScale.setChecked(config.Tracking_windowScalingOn)
         self.setparameterswid.backgroundSubstraction.setChecked(config.Processing_backgroundSubstractionOn)
+        self.setparameterswid.latticeTracking.setChecked(config.Tracking_latticeOn)
         self.setparameterswid.value1.setText(str(config.Tracking_processNoise.diagonal()[0]))
         self.setparameterswid.value2.setText(str(config.Tracking_processNoise.diagonal()[1]))
         self.setparameterswid.value3.setText(str(config.Tracking_processNoise.diagonal()[2]))
@@ -763,7 +885,7 @@ class MainWindow(QMainWindow):
         if filename:
             output = open(filename, 'w')
             backgroundsublist = [float(self.setparameterswid.value1.text()), float(self.setparameterswid.value2.text()), float(self.setparameterswid.value3.text()), float(self.setparameterswid.value4.text())]
-            writelist = [self.setparameterswid.inputPrecision.value(), self.setparameterswid.integrationWindowScale.isChecked(), self.setparameterswid.integrationWindowRadius.value(), self.setparameterswid.spotIdentification.currentText(), self.setparameterswid.validationRegionSize.value(), self.setparameterswid.determinationCoefficient.value(), self.setparameterswid.backgroundSubstraction.isChecked(), backgroundsublist]
+            writelist = [self.setparameterswid.inputPrecision.value(), self.setparameterswid.integrationWindowScale.isChecked(), self.setparameterswid.integrationWindowRadius.value(), str(self.setparameterswid.spotIdentification.currentText()), self.setparameterswid.validationRegionSize.value(), self.setparameterswid.determinationCoefficient.value(), self.setparameterswid.backgroundSubstraction.isChecked(), backgroundsublist]
             pickle.dump(writelist, output)
 
     #Load user values from a file to the widget
@@ -804,6 +926,9 @@ class MainWindow(QMainWindow):
     # special quit-function as the normal window closing might leave something on the background
     def fileQuit(self):
         '''Special quit-function as the normal window closing might leave something on the background '''
+        if self.trackingThread is not None:
+            self.trackingThread.stop()
+            self.trackingThread.wait()
         QApplication.closeAllWindows()
         self.plotwid.canvas.close()
 
@@ -843,6 +968,23 @@ class MainWindow(QMainWindow):
             
             
 
+    def detectSpots(self):
+        """ Adds the spots found in the current image (see detection.detect_spots),
+        skipping those close to existing spots. """
+        existing = [(item.scenePos().x(), item.scenePos().y()) for item in self.scene.items()
+                    if isinstance(item, QGraphicsSpotView)]
+        spots = detect_spots(self.current_image)
+        self.scene.clearSelection()
+        added = 0
+        for x, y, radius in spots:
+            if any((x - x_item)**2 + (y - y_item)**2 < radius**2 for x_item, y_item in existing):
+                continue
+            item = QGraphicsSpotView(QPointF(x, y), radius)
+            self.scene.addItem(item)
+            item.setSelected(True)
+            added += 1
+        self.statusBar().showMessage("Detected %d spots." % added, 5000)
+
     ## Controlling the spots
     # doesn't do much, only lists how many scene items (circles) there is in the gui, a test for trying to name the spots
     def processSpots(self):
@@ -866,19 +1008,57 @@ class SpotControl(QObject):
 #######
 
 
+class TrackingThread(QThread):
+    """ Runs a TrackingEngine over all images of a loader in the background.
+
+    Emits "progress" with (image, results) at most
+    config.MainWindow_refreshRate times per second and always for the last
+    processed image, so the tracking speed does not depend on repainting.
+    """
+
+    def __init__(self, engine, loader, parent=None):
+        super(TrackingThread, self).__init__(parent)
+        self.engine = engine
+        self.loader = loader
+        self.error = None
+        self.last_emit = 0
+        self.latest = None
+
+    def run(self):
+        try:
+            self.engine.run(self.loader, self.report)
+        except Exception, err:
+            logger.exception("tracking failed")
+            self.error = err
+        if self.latest is not None:
+            self.emit(SIGNAL("progress"), *self.latest)
+
+    def report(self, image, results):
+        self.latest = (image, results)
+        now = time.time()
+        if now - self.last_emit >= 1.0 / config.MainWindow_refreshRate:
+            self.last_emit = now
+            self.emit(SIGNAL("progress"), image, results)
+            self.latest = None
+
+    def stop(self):
+        """ Stops the tracking after the current image. """
+        self.engine.stop()
+
+
 class Worker(QObject):
     """ Worker that manages the spots."""
 
-    def __init__(self, spots, energy, parent=None):
+    def __init__(self, spots, energy, n_energies=0, parent=None):
         super(Worker, self).__init__(parent)
         self.spots_map = {}
-        for spot in spots:
-            pos = spot.scenePos()
-            tracker = Tracker(pos.x(), pos.y(), spot.radius(), energy,
-                        input_precision = config.Tracking_inputPrecision,
-                        window_scaling = config.Tracking_windowScalingOn)
-#            tracker = TrackerPhysics(pos.x(), pos.y(), 217, 218, spot.radius(), energy)
-            self.spots_map[spot] = (QSpotModel(self), tracker)
+        self.engine = TrackingEngine([(spot.scenePos().x(), spot.scenePos().y(), spot.radius())
+                                            for spot in spots], energy, n_energies)
+        self.views = []
+        for index, (spot, model) in enumerate(zip(spots, self.engine.models)):
+            # index of the spot in the engine's TrackerBank
+            self.spots_map[spot] = (QSpotModel(self, model), index)
+            self.views.append(spot)
 
         for view, tup in self.spots_map.iteritems():
             # view = QGraphicsSpotView, tup = (QSpotModel, tracker) -> tup[0] = QSpotModel
@@ -886,34 +1066,23 @@ class Worker(QObject):
             self.connect(tup[0], SIGNAL("radiusChanged"), view.onRadiusChange)
 
     def process(self, image):
-        for model, tracker in self.spots_map.itervalues():
-            tracker_result = tracker.feed_image(image)
-            # feed_image returns x, y, intensity, energy and radius
-            model.update(*tracker_result)
+        self.notify(self.engine.process(image))
+
+    def notify(self, results):
+        """ Moves the spot views to the given engine results. """
+        for view, tracker_result in zip(self.views, results):
+            # engine returns x, y, intensity, energy and radius for each spot
+            self.spots_map[view][0].notify(*tracker_result)
 
     def save(self, filename):
-        intensities = [model.m.intensity for model, tracker \
-                                in self.spots_map.itervalues()]
-        energy = [model.m.energy for model, tracker in self.spots_map.itervalues()]
-        zipped = zip(energy[0], *intensities)
-        np.savetxt(filename + ".int", zipped)
-        x = [model.m.x for model, tracker \
-                in self.spots_map.itervalues()]
-        y = [model.m.y for model, tracker \
-                in self.spots_map.itervalues()]
-        x.extend(y)
-        zipped = zip(energy[0], *x)
-        np.savetxt(filename + ".pos", zipped)
+        self.engine.save(filename)
         
 ##### H #####        
     def saveloc(self, filename):
-        # model = QSpotModel object tracker = tracker
-        # dict function .itervalues() = return an iterator over the mapping's values
-        energy = [model.m.energy for model, tracker in self.spots_map.itervalues()]
-        locationx = [model.m.x for model, tracker in self.spots_map.itervalues()]
-        locationy = [model.m.y for model, tracker in self.spots_map.itervalues()]
-        radius = [model.m.radius for model, tracker in self.spots_map.itervalues()]
-        locations = [locationx, locationy, radius]
+        # one (energy, x, y, radius) tuple of lists per spot, in tracking order
+        results = self.engine.results
+        energy = [results.energy.tolist()] * len(self.views)
+        locations = [results.x.tolist(), results.y.tolist(), results.radius.tolist()]
         zipped = zip(energy, *locations)
         output = open(filename, 'wb')
         pickle.dump(zipped, output)
@@ -7,13 +7,22 @@ Import routines for different LEED file formats
 """
 
 
+import os
+import json
+import hashlib
+import collections
+import mmap
+import fnmatch
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
-import PyQt4.QtGui as qt
 
 # load regular expression package (for parsing of energy from file name)
 import re
 
 from base import logger
+from . import config
+from .timing import timers
 
 #### load packages for available file types ####
 formats_available = ['IMG']
@@ -27,6 +36,19 @@ try:
     formats_available.append("PIL")    
 except:
     logger.warning("The Image package (Python Imaging Library) is not properly installed.")
+try:
+    import h5py
+    formats_available.append("HDF5")
+except:
+    logger.warning("The h5py package is not properly installed.")
+
+def is_mapped(image):
+    """ Returns whether the data of an array is a memory map of a file. """
+    while image is not None:
+        if isinstance(image, (np.memmap, mmap.mmap)):
+            return True
+        image = getattr(image, "base", None)
+    return False
 
 class ImageLoader(object):
     """ Abstract base class for a class loading LEED images.
@@ -36,17 +58,95 @@ class ImageLoader(object):
 
     Subclasses may override (default: from filename with regex)
         - get_energy(image_path)
+
+    Subclasses may override (default: energy only)
+        - scan(image_path), returning the information stored in the index
+
+    With prefetch > 0 the next prefetch images are read in background
+    threads while the current one is processed.
+
+    With use_index the results of scan are kept in a DatasetIndex per image
+    directory (in the cache directory config.IO_indexDirectory), so that
+    reopening a known series needs no file access.
+
+    With cache_size > 0 up to cache_size bytes of decoded images are kept
+    in a LRU cache by energy, shared by navigation and tracking runs.
     """
-    def __init__(self, image_paths, regex):
+    def __init__(self, image_paths, regex, prefetch=0, use_index=False, cache_size=0):
         # build a dictionary with energy as key and imagePath as value
         self.regex = regex
         self.files = {}
+        # information about every image path (see scan)
+        self.info = {}
+        if use_index:
+            self.info = self.scan_indexed(image_paths)
+        else:
+            for image_path in image_paths:
+                self.info[image_path] = {"energy": self.get_energy(image_path)}
         for image_path in image_paths:
-            energy = self.get_energy(image_path)
-            self.files[energy] = image_path
+            self.files[self.info[image_path]["energy"]] = image_path
         self.energies = sorted(self.files.keys())
+        self.setup_reading(prefetch, cache_size)
+
+    def setup_reading(self, prefetch, cache_size=0):
+        """ Initializes read-ahead buffer and cache and starts at the lowest energy. """
+        # LRU cache: energy -> image
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.evictions = 0
+        # read-ahead buffer: index -> AsyncResult of get_image
+        self.prefetch = prefetch
+        self.pending = {}
+        self.pool = None
+        if self.prefetch:
+            self.pool = ThreadPool(max(1, min(prefetch, config.IO_prefetchThreads)))
+        self.hits = 0
+        self.misses = 0
+        self.stalls = 0
         self.restart()
 
+    def scan(self, image_path):
+        """ Returns a dictionary with the energy (and further header
+        information) of an image. """
+        info = {"energy": self.get_energy(image_path)}
+        if config.IO_indexStatistics:
+            image = self.get_image(image_path)
+            info["min"], info["max"] = float(image.min()), float(image.max())
+        return info
+
+    def scan_indexed(self, image_paths):
+        """ Scans the images, reusing valid entries of the sidecar indices.
+
+        Images missing in the index are scanned in parallel threads.
+        """
+        indices = {}
+        info = {}
+        missing = []
+        for image_path in image_paths:
+            directory = os.path.dirname(os.path.abspath(image_path))
+            if directory not in indices:
+                indices[directory] = DatasetIndex(directory, self)
+            entry = indices[directory].lookup(image_path)
+            if entry is None:
+                missing.append(image_path)
+            else:
+                info[image_path] = entry
+        if missing:
+            pool = ThreadPool(max(1, min(len(missing), config.IO_indexThreads)))
+            try:
+                scanned = pool.map(self.scan, missing)
+            finally:
+                pool.terminate()
+            for image_path, entry in zip(missing, scanned):
+                directory = os.path.dirname(os.path.abspath(image_path))
+                info[image_path] = indices[directory].store(image_path, entry)
+            for index in indices.itervalues():
+                index.save()
+        return info
+
     def get_energy(self, image_path):
         m = re.search(self.regex, image_path)
         if m is None:
@@ -63,6 +163,90 @@ class ImageLoader(object):
     def restart(self):
         """ Start at lowest energy again. """
         self.index = -1
+        self.read_ahead()
+
+    def read_ahead(self):
+        """ Schedules the images following the current one for prefetching. """
+        if not self.prefetch:
+            return
+        wanted = range(self.index + 1, min(self.index + 1 + self.prefetch, len(self.energies)))
+        # forget images outside the window (their results are discarded)
+        for index in self.pending.keys():
+            if index not in wanted:
+                del self.pending[index]
+        for index in wanted:
+            if index not in self.pending and self.energies[index] not in self.cache:
+                path = self.files[self.energies[index]]
+                self.pending[index] = self.pool.apply_async(self.get_image, (path,))
+
+    def load(self, index):
+        """ Returns the image at index, from the cache or the read-ahead
+        buffer if possible. """
+        with timers("load"):
+            energy = self.energies[index]
+            image = self.cache.pop(energy, None)
+            if image is not None:
+                self.cache_hits += 1
+                self.cache[energy] = image
+                self.read_ahead()
+                return image
+            if self.cache_size:
+                self.cache_misses += 1
+            result = self.pending.pop(index, None)
+            if result is None:
+                if self.prefetch:
+                    self.misses += 1
+                image = self.get_image(self.files[self.energies[index]])
+            else:
+                if result.ready():
+                    self.hits += 1
+                else:
+                    self.stalls += 1
+                image = result.get()
+            image = self.store(energy, image)
+            self.read_ahead()
+            return image
+
+    def store(self, energy, image):
+        """ Puts an image into the cache, evicting the least recently used ones.
+
+        Returns the image to hand out: memory mapped images are copied
+        into memory before they are cached, as every map keeps a file
+        descriptor open and its pages are not counted in the cache size.
+        """
+        if image.nbytes > self.cache_size:
+            return image
+        if is_mapped(image):
+            image = np.array(image)
+        # cached images are shared, so they must not be changed
+        image.setflags(write=False)
+        self.cache[energy] = image
+        self.cache_bytes += image.nbytes
+        while self.cache_bytes > self.cache_size:
+            energy, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= evicted.nbytes
+            self.evictions += 1
+        return image
+
+    def clear_cache(self):
+        """ Empties the image cache. """
+        self.cache.clear()
+        self.cache_bytes = 0
+
+    def statistics(self):
+        """ Returns the read-ahead counters (hits, misses, stalls) and
+        the cache counters (cache_hits, cache_misses, evictions, cache_bytes). """
+        return {"hits": self.hits, "misses": self.misses, "stalls": self.stalls,
+                "cache_hits": self.cache_hits, "cache_misses": self.cache_misses,
+                "evictions": self.evictions, "cache_bytes": self.cache_bytes}
+
+    def close(self):
+        """ Stops the read-ahead threads. """
+        self.pending = {}
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.prefetch = 0
 
     def previous(self):
         """ Get image at next lower beam energy. """
@@ -71,14 +255,14 @@ class ImageLoader(object):
         else:
            self.index -= 1
            energy = self.energies[self.index]
-           return self.get_image(self.files[energy]), energy
+           return self.load(self.index), energy
 
     def next(self):
         """ Get image at next higher beam energy. """
         if self.index < len(self.energies)-1:
             self.index += 1
             energy = self.energies[self.index]
-            return self.get_image(self.files[energy]), energy
+            return self.load(self.index), energy
         else:
             raise StopIteration()
 
@@ -97,6 +281,16 @@ class ImgImageLoader(ImageLoader):
     def get_energy(self, image_path):
         with open(image_path, "rb") as f:
             return self.load_header(f)["Beam Voltage (eV)"]
+
+    def scan(self, image_path):
+        with open(image_path, "rb") as f:
+            header = self.load_header(f)
+        info = {"energy": header["Beam Voltage (eV)"], "offset": header["length"],
+                "shape": [header["y2"]-header["y1"]+1, header["x2"]-header["x1"]+1]}
+        if config.IO_indexStatistics:
+            image = self.map_image(image_path, info)
+            info["min"], info["max"] = float(image.min()), float(image.max())
+        return info
     
     def load_header(self, f):
         # find header length
@@ -124,6 +318,8 @@ class ImgImageLoader(ImageLoader):
         return header
 
     def get_image(self, image_path):
+        if config.IO_memoryMap:
+            return self.map_image(image_path)
         with open(image_path, "rb") as f:
             header = self.load_header(f) 
             # jump to begin of image
@@ -138,6 +334,22 @@ class ImgImageLoader(ImageLoader):
             image = image.reshape((size))
             return image
 
+    def map_image(self, image_path, info=None):
+        """ Maps the image data into memory without reading it.
+
+        Only the header is read (or nothing if its offset and shape are
+        known from the index), the pixels are paged in from disk when
+        they are accessed.
+        """
+        if info is None:
+            info = self.info.get(image_path)
+        if info is None or "offset" not in info:
+            info = self.scan(image_path)
+        image = np.memmap(image_path, dtype = np.uint16, mode = "r",
+                          offset = info["offset"], shape = tuple(info["shape"]))
+        # plain ndarray view, so that results of calculations are no memmaps
+        return image.view(np.ndarray)
+
 class FitsImageLoader(ImageLoader):
     """ Load .fit image files (common format). """
     
@@ -155,6 +367,268 @@ class PILImageLoader(ImageLoader):
         data = np.asarray(im.convert('L'), dtype = np.uint16)
         return data
 
+class CubeImageLoader(ImageLoader):
+    """ Load a whole energy series from one HDF5 image cube (see write_cube).
+
+    The cube is read lazily per energy or per spatial window (get_window).
+    Uncompressed, unchunked cubes are memory-mapped directly.
+    """
+
+    def __init__(self, image_paths, regex=None, prefetch=0, use_index=False, cache_size=0):
+        if isinstance(image_paths, basestring):
+            image_paths = [image_paths]
+        if len(image_paths) != 1:
+            raise IOError("Please choose a single image cube file.")
+        self.regex = regex
+        self.path = image_paths[0]
+        self.h5file = h5py.File(self.path, "r")
+        try:
+            self.cube = self.h5file["images"]
+            energies = self.h5file["energy"][:]
+        except KeyError:
+            raise IOError("%s is not an image cube." % self.path)
+        offset = self.cube.id.get_offset()
+        if offset is not None and self.cube.chunks is None:
+            self.cube = np.memmap(self.path, dtype = self.cube.dtype, mode = "r",
+                                  offset = offset, shape = self.cube.shape)
+        # the "paths" of the images are their indices in the cube
+        self.files = dict((energy.item(), index) for index, energy in enumerate(energies))
+        self.info = dict((index, {"energy": energy.item()}) for index, energy in enumerate(energies))
+        self.energies = sorted(self.files.keys())
+        self.setup_reading(prefetch, cache_size)
+
+    def get_energy(self, index):
+        return self.info[index]["energy"]
+
+    def get_image(self, index):
+        return np.asarray(self.cube[index])
+
+    def get_window(self, energy, y_slice, x_slice):
+        """ Returns only the given window of the image at energy. """
+        return np.asarray(self.cube[self.files[energy], y_slice, x_slice])
+
+    def close(self):
+        super(CubeImageLoader, self).close()
+        self.cube = None
+        self.h5file.close()
+
+def write_cube(loader, filename, compression=None, chunks=None):
+    """ Writes all images of a loader into one HDF5 image cube.
+
+    The cube holds the dataset "images" with the shape (energy, y, x) and
+    the dataset "energy" with the energies.
+
+    compression: None (memory-mappable), "gzip" or "lzf"
+    chunks: chunk shape (y, x) within one image (default: whole images
+            if compressed, no chunking otherwise)
+    """
+    energies = loader.energies
+    loader.restart()
+    npimage, energy = loader.next()
+    shape = (len(energies),) + npimage.shape
+    if compression is not None and chunks is None:
+        chunks = npimage.shape
+    if chunks is not None:
+        chunks = (1,) + tuple(min(c, s) for c, s in zip(chunks, npimage.shape))
+    with h5py.File(filename, "w") as f:
+        f.create_dataset("energy", data = np.asarray(energies))
+        cube = f.create_dataset("images", shape = shape, dtype = npimage.dtype,
+                                chunks = chunks, compression = compression)
+        cube[0] = npimage
+        for index, (npimage, energy) in enumerate(loader, 1):
+            if npimage.shape != shape[1:]:
+                raise IOError("All images need to have the same shape.")
+            cube[index] = npimage
+    loader.restart()
+
+def index_directory():
+    """ Returns the directory of the index files (config.IO_indexDirectory,
+    default: easyleed/index in the user's cache directory). """
+    if config.IO_indexDirectory:
+        return os.path.expanduser(config.IO_indexDirectory)
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "easyleed", "index")
+
+class DatasetIndex(object):
+    """ File in the cache directory storing the scan results of the images
+    in a directory (the data directories are not written to).
+
+    Every entry holds the information returned by ImageLoader.scan (energy,
+    header offset, frame shape, min/max, ...) together with size and mtime
+    of the file, by which it is validated. The index is discarded if it was
+    made by a different loader class or energy regex.
+    """
+
+    def __init__(self, directory, loader):
+        directory = os.path.abspath(directory)
+        # one file per image directory, named by the hash of its path
+        name = hashlib.sha1(directory.encode("utf-8")).hexdigest() + ".json"
+        self.path = os.path.join(index_directory(), name)
+        self.key = [loader.__class__.__name__, loader.regex, directory]
+        self.entries = {}
+        self.changed = False
+        try:
+            with open(self.path, "r") as f:
+                content = json.load(f)
+            if content.get("key") == self.key:
+                self.entries = content["entries"]
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+
+    def lookup(self, image_path):
+        """ Returns the entry of an image or None if missing or outdated. """
+        entry = self.entries.get(os.path.basename(image_path))
+        if entry is None:
+            return None
+        stat = os.stat(image_path)
+        if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            return None
+        return entry
+
+    def store(self, image_path, info):
+        """ Adds the scan results of an image and returns the new entry. """
+        stat = os.stat(image_path)
+        entry = dict(info, path=os.path.basename(image_path),
+                     size=stat.st_size, mtime=stat.st_mtime)
+        self.entries[entry["path"]] = entry
+        self.changed = True
+        return entry
+
+    def save(self):
+        """ Writes the index file if it changed (failures are only logged). """
+        if not self.changed:
+            return
+        # not writable: the series is scanned again next time
+        self.changed = False
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(temporary, "w") as f:
+                json.dump({"key": self.key, "entries": self.entries}, f)
+            os.rename(temporary, self.path)
+        except (IOError, OSError), err:
+            logger.info("Could not write index file %s: %s" % (self.path, err))
+            if os.path.exists(temporary):
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+
+""" Fields stored per spot in a result file (in this order after the energy). """
+RESULT_FIELDS = ["x", "y", "intensity", "radius", "status"]
+
+class ResultWriter(object):
+    """ Appends tracking results energy by energy to a binary result file.
+
+    The file starts with the magic "EASYLEED", the length of the header as
+    little-endian uint64 and a JSON header (number of spots, spot seeds and
+    parameters), padded to a multiple of 8 bytes. Each energy follows as one
+    row of float64: the energy, then x, y, intensity, radius and status of
+    all spots. Every row is flushed when written, so a killed run leaves a
+    readable file with all energies processed so far.
+    """
+    magic = "EASYLEED"
+
+    def __init__(self, filename, spots, parameters=None):
+        """
+        filename: name of the result file
+        spots: list of (x, y, radius) start positions
+        parameters: dictionary of the tracking parameters (stored as metadata)
+        """
+        self.n_spots = len(spots)
+        header = json.dumps({"version": 1, "n_spots": self.n_spots,
+                             "fields": RESULT_FIELDS,
+                             "spots": [[float(v) for v in spot] for spot in spots],
+                             "parameters": parameters or {}})
+        header += " " * (-len(header) % 8)
+        self.file = open(filename, "wb")
+        self.file.write(self.magic)
+        self.file.write(np.array(len(header), dtype="<u8").tostring())
+        self.file.write(header)
+        self.sync()
+        self.row = np.empty(1 + len(RESULT_FIELDS) * self.n_spots, dtype="<f8")
+
+    @classmethod
+    def resume(cls, filename, count):
+        """ Reopens a result file to append after its first count energies. """
+        results = ResultFile(filename)
+        if len(results) < count:
+            raise IOError("%s holds less than %d energies." % (filename, count))
+        size = results.offset + 8 * results.row_length * count
+        writer = cls.__new__(cls)
+        writer.n_spots = results.n_spots
+        writer.row = np.empty(results.row_length, dtype="<f8")
+        # release the memory map before truncating the file
+        del results
+        writer.file = open(filename, "r+b")
+        writer.file.truncate(size)
+        writer.file.seek(size)
+        return writer
+
+    def append(self, results, status=None):
+        """ Writes the results of one energy.
+
+        results: list of (x, y, intensity, energy, radius), one per spot
+        status: fit status of the spots (default: 0)
+        """
+        results = np.asarray(results, dtype=float).reshape(self.n_spots, 5)
+        n = self.n_spots
+        self.row[0] = results[0, 3] if n else np.nan
+        self.row[1:1+3*n] = results[:, :3].T.ravel()
+        self.row[1+3*n:1+4*n] = results[:, 4]
+        self.row[1+4*n:] = 0 if status is None else status
+        self.file.write(self.row.tostring())
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        if config.IO_resultsSync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+class ResultFile(object):
+    """ Reads a file written by ResultWriter through memory mapping.
+
+    Offers the attributes of a ResultStore: energy and the arrays x, y,
+    intensity, radius and status of shape (n_spots, n_energies). An
+    incomplete last row (of a killed run) is ignored.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            if f.read(len(ResultWriter.magic)) != ResultWriter.magic:
+                raise IOError("%s is not an easyleed result file." % filename)
+            length = int(np.fromstring(f.read(8), dtype="<u8")[0])
+            self.header = json.loads(f.read(length))
+        self.n_spots = self.header["n_spots"]
+        self.spots = self.header["spots"]
+        self.parameters = self.header["parameters"]
+        self.offset = len(ResultWriter.magic) + 8 + length
+        self.row_length = 1 + len(RESULT_FIELDS) * self.n_spots
+        self.count = (os.path.getsize(filename) - self.offset) // (8 * self.row_length)
+        if self.count:
+            self.rows = np.memmap(filename, dtype="<f8", mode="r", offset=self.offset,
+                                  shape=(self.count, self.row_length))
+        else:
+            self.rows = np.empty((0, self.row_length))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def energy(self):
+        return self.rows[:, 0]
+
+    def __getattr__(self, name):
+        if name in RESULT_FIELDS:
+            start = 1 + RESULT_FIELDS.index(name) * self.n_spots
+            return self.rows[:, start:start+self.n_spots].T
+        raise AttributeError(name)
+
 class ImageFormat:
     """ Class describing an image format. """
     def __init__(self, abbrev, extensions, loader):
@@ -173,9 +647,85 @@ class ImageFormat:
 IMAGE_FORMATS = dict([str(format_), format_] for format_ in \
         [ImageFormat("FITS", ["*.fit", "*.fits"], FitsImageLoader),
         ImageFormat("PIL", ["*.tif", "*.tiff", "*.png"], PILImageLoader),
-        ImageFormat("IMG", ["*.img"], ImgImageLoader)] \
+        ImageFormat("IMG", ["*.img"], ImgImageLoader),
+        ImageFormat("HDF5", ["*.h5", "*.hdf5"], CubeImageLoader)] \
              if format_.abbrev in formats_available)
 
+def get_format(image_path):
+    """ Returns the ImageFormat whose extensions match the given file name. """
+    for format_ in IMAGE_FORMATS.itervalues():
+        for extension in format_.extensions:
+            if fnmatch.fnmatch(image_path.lower(), extension):
+                return format_
+    raise IOError("Unsupported file type: %s" % image_path)
+
+def find_images(paths, format_=None):
+    """ Expands the given files and directories to a sorted list of image files.
+
+    paths: list of image files and/or directories containing image files
+    format_: ImageFormat to look for in directories (default: all available formats)
+    """
+    formats = IMAGE_FORMATS.values() if format_ is None else [format_]
+    extensions = [extension for f in formats for extension in f.extensions]
+    image_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if any(fnmatch.fnmatch(filename.lower(), ext) for ext in extensions):
+                    image_paths.append(os.path.join(path, filename))
+        else:
+            image_paths.append(path)
+    return image_paths
+
+def contrast_limits(array, percentiles=None, samples=None):
+    """ Returns robust display limits (low, high) of an image.
+
+    The limits are the given percentiles (default: config.Display_percentiles)
+    of a regular subsample of about samples pixels (default: config.Display_samples).
+    """
+    if percentiles is None:
+        percentiles = config.Display_percentiles
+    if samples is None:
+        samples = config.Display_samples
+    step = max(1, int((array.size / float(samples))**0.5))
+    low, high = np.percentile(array[::step, ::step], percentiles)
+    if high <= low:
+        high = low + 1
+    return low, high
+
+class DisplayConverter(object):
+    """ Converts images to uint8 for display.
+
+    Images of up to 16 bit unsigned integers are converted through a lookup
+    table, which is only rebuilt if the contrast limits move by more than
+    one count or tolerance times their distance (the small changes of the
+    limits from image to image are not visible).
+    """
+
+    def __init__(self, tolerance=0.005):
+        self.tolerance = tolerance
+        self.limits = None
+        self.lut = None
+
+    def lookup_table(self, low, high):
+        """ Returns the lookup table mapping [low, high] onto [0, 255]. """
+        if self.limits is not None:
+            step = max(1.0, self.tolerance * (high - low))
+            if abs(low - self.limits[0]) <= step and abs(high - self.limits[1]) <= step:
+                return self.lut
+        values = (np.arange(2**16) - low) * (255.0 / (high - low))
+        self.lut = np.clip(values, 0, 255).astype(np.uint8)
+        self.limits = (low, high)
+        return self.lut
+
+    def __call__(self, array, limits=None):
+        """ Returns array scaled to uint8 within limits (default: contrast_limits). """
+        low, high = contrast_limits(array) if limits is None else limits
+        if array.dtype.kind == "u" and array.dtype.itemsize <= 2:
+            return self.lookup_table(low, high).take(array)
+        scaled = (np.asarray(array, dtype=float) - low) * (255.0 / (high - low))
+        return np.clip(scaled, 0, 255).astype(np.uint8)
+
 def normalize255(array):
     """ Returns a normalized array of uint8."""
     nmin, nmax = array.min(), array.max()
@@ -185,14 +735,3 @@ def normalize255(array):
     if scale != 1.0:
         array = array * scale
     return array.astype("uint8")
-
-def npimage2qimage(npimage):
-    """ Converts numpy grayscale image to qimage."""
-    h, w = npimage.shape
-    npimage = normalize255(npimage)
-    # second w to avoid problems if image is not 32-bit aligned
-    # --> indicates bytesPerLine
-    qimage = qt.QImage(npimage.data, w, h, w, qt.QImage.Format_Indexed8)
-    for i in range(256):
-        qimage.setColor(i, qt.qRgb(i, i, i))
-    return qimage
@@ -132,3 +132,125 @@ class PVKalmanFilter3(AbstractPVKalmanFilter):
         F = [[1, 0, pos_up, 0], [0, 1, 0, pos_up], [0, 0, v_up, 0], [0, 0, 0, v_up]]
         super(PVKalmanFilter3, self).predict(F, *args, **kwargs)
         self.old_time = time
+
+""" Coefficients of the expansion of the 1/sqrt(E) movement, see PVKalmanFilter1-3.
+Entry k multiplies dt**(k+1) / old_time**(k+1) in the velocity update. """
+TRANSITION_COEFFICIENTS = [-1.5, 1.875, -2.1875]
+
+def inv2x2(A):
+    """ Returns the inverses of a stack of 2x2 matrices (shape (N, 2, 2)). """
+    A = np.asarray(A, dtype=float)
+    det = A[:, 0, 0] * A[:, 1, 1] - A[:, 0, 1] * A[:, 1, 0]
+    inv = np.empty_like(A)
+    inv[:, 0, 0] = A[:, 1, 1]
+    inv[:, 1, 1] = A[:, 0, 0]
+    inv[:, 0, 1] = -A[:, 0, 1]
+    inv[:, 1, 0] = -A[:, 1, 0]
+    inv /= det[:, None, None]
+    return inv
+
+class PVKalmanFilterBank(object):
+    """ Bank of N position-velocity Kalman filters sharing one array state.
+
+    The states are stored as an (N, 4) array x and the covariances as an
+    (N, 4, 4) array P, so that all filters are predicted, gated and updated
+    at once. The transition models of PVKalmanFilter0-3 are selected with
+    order (0-3).
+    """
+
+    def __init__(self, x_in, y_in, P, time, order=2, vx_in=0, vy_in=0):
+        """ Initialize the filter bank.
+
+        x_in, y_in: start positions (length N)
+        P: start state covariance matrix (4x4 for all or Nx4x4)
+        time: start time (scalar or length N)
+        order: transition model (see PVKalmanFilter0-3)
+        """
+        super(PVKalmanFilterBank, self).__init__()
+        x_in = np.asarray(x_in, dtype=float)
+        n = len(x_in)
+        self.x = np.empty((n, 4))
+        self.x[:, 0] = x_in
+        self.x[:, 1] = y_in
+        self.x[:, 2] = vx_in
+        self.x[:, 3] = vy_in
+        P = np.asarray(P, dtype=float)
+        self.P = np.array(np.broadcast_to(P, (n, 4, 4)))
+        self.old_time = np.array(np.broadcast_to(np.asarray(time, dtype=float), (n,)))
+        self.order = order
+
+    def __len__(self):
+        return len(self.x)
+
+    def transition(self, time):
+        """ Returns the position and velocity update factors for the given time. """
+        dt = time - self.old_time
+        v_up = np.ones_like(dt)
+        pos_up = dt.copy()
+        for k, c in enumerate(TRANSITION_COEFFICIENTS[:self.order]):
+            coefficient = c / self.old_time**(k + 1)
+            v_up += coefficient * dt**(k + 1)
+            pos_up += coefficient * dt**(k + 2) / (k + 2)
+        return pos_up, v_up
+
+    def predict(self, time, Q = np.zeros((4, 4))):
+        """ Predict next state of all filters.
+
+        time: new time (scalar or length N)
+        Q: process covariance matrix (4x4 for all or Nx4x4)
+        """
+        pos_up, v_up = self.transition(time)
+        F = np.zeros_like(self.P)
+        F[:, 0, 0] = F[:, 1, 1] = 1
+        F[:, 0, 2] = F[:, 1, 3] = pos_up
+        F[:, 2, 2] = F[:, 3, 3] = v_up
+        self.x = np.einsum("nij,nj->ni", F, self.x)
+        self.P = np.einsum("nij,njk,nlk->nil", F, self.P, F) + Q
+        self.old_time = np.array(np.broadcast_to(np.asarray(time, dtype=float), (len(self),)))
+
+    def predict_measurement(self):
+        """ Returns the predicted measurements (N, 2). """
+        return self.x[:, :2].copy()
+
+    def predict_measurement_covariance(self, R=None):
+        """ Returns the covariance matrices of the predicted measurements (N, 2, 2). """
+        if R is None:
+            return self.P[:, :2, :2].copy()
+        return self.P[:, :2, :2] + R
+
+    def measurement_distance(self, z, R=None):
+        """ Returns the squared Mahalanobis distances of the given measurements.
+
+        z: measurement vectors (N, 2)
+        R: measurement covariance matrices (N, 2, 2)
+        """
+        residual = np.asarray(z, dtype=float) - self.predict_measurement()
+        S_inv = inv2x2(self.predict_measurement_covariance(R))
+        return np.einsum("ni,nij,nj->n", residual, S_inv, residual)
+
+    def update(self, z, R, mask=None):
+        """ Update state estimates.
+
+        z: measurement vectors (N, 2)
+        R: measurement covariance matrices (N, 2, 2)
+        mask: boolean array selecting the filters to update (default: all)
+        """
+        z = np.asarray(z, dtype=float)
+        R = np.asarray(R, dtype=float)
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        if not mask.any():
+            return
+        P = self.P[mask]
+        # K = P H^T S^-1 with H selecting the position
+        K = np.einsum("nij,njk->nik", P[:, :, :2], inv2x2(P[:, :2, :2] + R[mask]))
+        residual = z[mask] - self.x[mask, :2]
+        self.x[mask] += np.einsum("nij,nj->ni", K, residual)
+        # P = (1 - K H) P
+        self.P[mask] = P - np.einsum("nij,njk->nik", K, P[:, :2, :])
+
+    def get_position(self):
+        return self.x[:, 0].copy(), self.x[:, 1].copy()
+
+    def get_position_err(self):
+        return self.P[:, 0, 0]**0.5, self.P[:, 1, 1]**0.5
@@ -0,0 +1,126 @@
+"""
+easyleed.lattice
+----------------
+
+Common movement of all spots of a LEED pattern with energy.
+
+With increasing energy all spots move towards the (0,0) beam with a
+distance proportional to 1/sqrt(E). The LatticeModel describes the
+positions of all spots at one energy by a shared offset c and scale s,
+
+    p_i(E) = c(E) + s(E) * d_i,
+
+with fixed lattice coordinates d_i of the spots. c and s are fitted by
+linear least squares to the spots found at every energy, which places the
+spots that were not found and predicts the positions at the next energy.
+
+"""
+
+import numpy as np
+
+""" Weight of the first guess of the pattern center (the mean start position)
+relative to the sum of the squared scale changes (see LatticeModel.center). """
+CENTER_PRIOR = 1e-4
+
+class LatticeModel(object):
+    """ Shared offset and scale of all spots, fitted energy by energy. """
+
+    def __init__(self, x_in, y_in, energy):
+        """ x_in, y_in: start positions of the spots at energy """
+        start = np.column_stack((np.asarray(x_in, dtype=float), np.asarray(y_in, dtype=float)))
+        # first guess of the center, the coordinates are relative to it
+        self.origin = start.mean(axis=0) if len(start) else np.zeros(2)
+        self.coordinates = start - self.origin
+        # offset and scale at the last energy
+        self.offset = self.origin.copy()
+        self.scale = 1.0
+        self.energy = float(energy)
+        # standard deviation of the fitted positions around the model (nan: no fit)
+        self.sigma = np.nan
+        # sums of the least squares estimate of the center (see center)
+        self.center_sums = np.zeros(3)
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    @property
+    def fitted(self):
+        """ True if the offset and scale were fitted at the last energy. """
+        return not np.isnan(self.sigma)
+
+    def center(self):
+        """ Returns the estimated center of the pattern (the fixed point of
+        the movement), i.e. c* of offset = c* + scale * (origin - c*). """
+        weight, x_sum, y_sum = self.center_sums
+        return (np.array([x_sum, y_sum]) + CENTER_PRIOR * self.origin) / (weight + CENTER_PRIOR)
+
+    def predict(self, energy):
+        """ Returns the offset and scale expected at energy (1/sqrt(E) scaling
+        around the estimated center). """
+        scale = self.scale * (self.energy / energy)**0.5
+        center = self.center()
+        offset = center + (scale / self.scale) * (self.offset - center)
+        return offset, scale
+
+    def predict_positions(self, energy):
+        """ Returns the x and y positions of all spots expected at energy. """
+        offset, scale = self.predict(energy)
+        positions = offset + scale * self.coordinates
+        return positions[:, 0], positions[:, 1]
+
+    def positions(self):
+        """ Returns the positions (N, 2) of all spots at the last energy. """
+        return self.offset + self.scale * self.coordinates
+
+    def fit(self, z, mask, energy, min_spots=3):
+        """ Fits offset and scale to the measured positions z (N, 2) of the
+        spots selected by mask.
+
+        Spots deviating by more than three times the median deviation are
+        dropped once. With less than min_spots spots the predicted offset
+        and scale are used (fitted is False then).
+        """
+        offset, scale = self.predict(energy)
+        self.sigma = np.nan
+        selected = np.flatnonzero(mask)
+        for iteration in range(2):
+            if len(selected) < max(min_spots, 2):
+                break
+            d = self.coordinates[selected]
+            p = np.asarray(z, dtype=float)[selected]
+            d_mean, p_mean = d.mean(axis=0), p.mean(axis=0)
+            spread = ((d - d_mean)**2).sum()
+            if spread <= 0:
+                break
+            scale = ((d - d_mean) * (p - p_mean)).sum() / spread
+            offset = p_mean - scale * d_mean
+            deviation = np.sqrt(((p - offset - scale * d)**2).sum(axis=1))
+            if iteration == 0:
+                outliers = deviation > 3 * max(np.median(deviation), 1e-3)
+                if outliers.any():
+                    selected = selected[~outliers]
+                    continue
+            self.sigma = np.sqrt((deviation**2).sum() / max(2 * len(selected) - 3, 1))
+            break
+        if self.fitted:
+            weight = 1 - scale
+            self.center_sums += [weight**2, weight * (offset[0] - scale * self.origin[0]),
+                                 weight * (offset[1] - scale * self.origin[1])]
+        self.offset, self.scale, self.energy = np.asarray(offset, dtype=float), scale, float(energy)
+
+    def get_state(self):
+        """ Returns the state as a dictionary of arrays. """
+        return {"origin": self.origin.copy(), "coordinates": self.coordinates.copy(),
+                "offset": self.offset.copy(), "scale": np.array(self.scale),
+                "energy": np.array(self.energy), "sigma": np.array(self.sigma),
+                "center_sums": self.center_sums.copy()}
+
+    def set_state(self, state):
+        """ Restores a state returned by get_state. """
+        self.origin = np.array(state["origin"], dtype=float)
+        self.coordinates = np.array(state["coordinates"], dtype=float)
+        self.offset = np.array(state["offset"], dtype=float)
+        self.scale = float(state["scale"])
+        self.energy = float(state["energy"])
+        self.sigma = float(state["sigma"])
+        self.center_sums = np.array(state["center_sums"], dtype=float)
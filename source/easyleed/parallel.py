@@ -0,0 +1,188 @@
+"""
+easyleed.parallel
+-----------------
+
+Parallel tracking of spots in several processes.
+
+Every worker process tracks a contiguous shard of the spots with its own
+TrackerBank. Each image is copied once into shared memory, from where all
+workers read it, so only energies and results are sent between processes.
+
+"""
+
+import multiprocessing
+from multiprocessing import sharedctypes
+
+import numpy as np
+
+from . import config
+from .base import TrackerBank, logger
+from .batch import TrackingEngine, config_values
+from .timing import timers
+from .diagnostics import diagnostics
+
+def shared_array(shape, dtype):
+    """ Returns a numpy array of the given shape in shared memory and its buffer. """
+    dtype = np.dtype(dtype)
+    buffer_ = sharedctypes.RawArray("b", int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(buffer_, dtype=dtype).reshape(shape), buffer_
+
+def track_shard(connection, buffer_, shape, dtype, spots, energy, values, state=None):
+    """ Main function of a worker process tracking the given spots.
+
+    Waits for ("feed", energy) messages, tracks the spots in the image
+    found in the shared buffer and sends back the list of results and
+    the fit status of the spots. A ("state",) message is answered with
+    the state of the TrackerBank, which starts from state if given, a
+    ("timers",) message with the samples of the stage timers and a
+    ("diagnostics",) message with the counts of the tracking events.
+    """
+    for name, value in values.iteritems():
+        setattr(config, name, value)
+    npimage = np.frombuffer(buffer_, dtype=dtype).reshape(shape)
+    x, y, radius = np.asarray(spots, dtype=float).reshape(-1, 3).T
+    trackers = TrackerBank(x, y, radius, energy,
+                    input_precision = config.Tracking_inputPrecision,
+                    window_scaling = config.Tracking_windowScalingOn)
+    if state is not None:
+        trackers.set_state(state)
+    while True:
+        message = connection.recv()
+        if message[0] == "stop":
+            break
+        try:
+            if message[0] == "feed":
+                results = trackers.feed_image((npimage, message[1]))
+                connection.send((results, trackers.status))
+            elif message[0] == "state":
+                connection.send(trackers.get_state())
+            elif message[0] == "timers":
+                connection.send(timers.samples)
+                timers.reset()
+            elif message[0] == "diagnostics":
+                connection.send(diagnostics.counts)
+                diagnostics.reset()
+        except Exception, err:
+            connection.send(err)
+    connection.close()
+
+class ParallelTrackingEngine(TrackingEngine):
+    """ TrackingEngine distributing the spots over several processes.
+
+    Falls back to serial tracking if there are less than
+    config.Tracking_parallelMinSpots spots per process or if the lattice
+    model (config.Tracking_latticeOn), which needs all spots, is used.
+    """
+
+    def __init__(self, spots, energy, n_energies=0, processes=None):
+        """
+        spots: list of (x, y, radius) start positions
+        energy: energy at which the start positions were determined
+        n_energies: expected number of images (preallocates the results)
+        processes: number of worker processes (None or 0: number of CPUs)
+        """
+        super(ParallelTrackingEngine, self).__init__(spots, energy, n_energies)
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, len(spots) // config.Tracking_parallelMinSpots)
+        if config.Tracking_latticeOn:
+            processes = 1
+        self.shards = np.array_split(np.arange(len(spots)), max(processes, 1))
+        self.workers = []
+        self.connections = []
+        self.frame = None
+        self.closed = False
+
+    @property
+    def parallel(self):
+        return len(self.shards) > 1
+
+    def start(self, npimage):
+        """ Starts the worker processes with a shared buffer for images like npimage. """
+        self.frame, buffer_ = shared_array(npimage.shape, npimage.dtype)
+        values = config_values()
+        # the workers continue from the state of the serial TrackerBank
+        state = self.trackers.get_state()
+        for shard in self.shards:
+            connection, child_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=track_shard,
+                    args=(child_connection, buffer_, npimage.shape, npimage.dtype,
+                          [self.spots[i] for i in shard], self.energy, values,
+                          dict((name, value[shard]) for name, value in state.iteritems())))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            self.connections.append(connection)
+
+    def process(self, image):
+        """ Feeds one (npimage, energy) tuple to all trackers.
+
+        Returns the list of (x, y, intensity, energy, radius) results.
+        """
+        if not self.parallel:
+            return super(ParallelTrackingEngine, self).process(image)
+        npimage, energy = image
+        if self.closed:
+            raise RuntimeError("The worker processes have already been stopped.")
+        if self.frame is None:
+            self.start(npimage)
+        elif npimage.shape != self.frame.shape or npimage.dtype != self.frame.dtype:
+            raise IOError("All images need to have the same shape and type.")
+        # publish the image once, the workers read it from shared memory
+        self.frame[...] = npimage
+        for connection in self.connections:
+            connection.send(("feed", energy))
+        # read all replies before raising, so the connections stay in step
+        messages = [connection.recv() for connection in self.connections]
+        for message in messages:
+            if isinstance(message, Exception):
+                self.close()
+                raise message
+        results = []
+        status = []
+        for message in messages:
+            results.extend(message[0])
+            status.append(message[1])
+        self.store(results, np.concatenate(status))
+        return results
+
+    def get_state(self):
+        if self.workers:
+            self.collect_state()
+        return super(ParallelTrackingEngine, self).get_state()
+
+    def collect_state(self):
+        """ Copies the tracker states of the worker processes into self.trackers. """
+        for connection in self.connections:
+            connection.send(("state",))
+        states = [connection.recv() for connection in self.connections]
+        self.trackers.set_state(dict((name, np.concatenate([state[name] for state in states]))
+                                     for name in states[0]))
+
+    def close(self):
+        """ Stops the worker processes (keeping their tracker state, timings
+        and event counts). """
+        if self.workers:
+            try:
+                self.collect_state()
+                for connection in self.connections:
+                    connection.send(("timers",))
+                for connection in self.connections:
+                    timers.merge(connection.recv())
+                for connection in self.connections:
+                    connection.send(("diagnostics",))
+                for connection in self.connections:
+                    diagnostics.merge(connection.recv())
+            except (IOError, EOFError):
+                logger.warning("Could not collect the tracker state of the worker processes.")
+        for connection in self.connections:
+            try:
+                connection.send(("stop",))
+            except IOError:
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.connections = []
+        self.frame = None
+        self.closed = True
@@ -12,6 +12,7 @@ np.seterr(all="ignore")
 import scipy.optimize
 
 from base import *
+from kalman import PVKalmanFilter0, PVKalmanFilter1, PVKalmanFilter2, PVKalmanFilter3, PVKalmanFilterBank
 
 logging.basicConfig(level=logging.INFO)
 
@@ -22,23 +23,27 @@ class Background:
         self.is_constant = is_constant
         func = partial(func, size)
         if self.is_constant:
-            self.image = func()
+            self.image = np.asarray(func(), dtype=float)
         else:
             self.func = func
-    def __call__(self):
+    def __call__(self, random=None):
+        """ Returns a new background image (as float).
+
+        random: RandomState used by random backgrounds (default: np.random)
+        """
         if self.is_constant:
             return self.image.copy()
         else:
-            return self.func()
+            return np.asarray(self.func(random=random), dtype=float)
 
-def back_uniform(size, level=0):
+def back_uniform(size, level=0, random=None):
     return np.ones(size) * level
     
-def back_poisson(size, mu=1):
-    return np.random.poisson(mu, size)
+def back_poisson(size, mu=1, random=None):
+    return (random or np.random).poisson(mu, size)
 
-def back_normal(size, mu=2, sigma=1):
-    return abs(sigma * np.random.randn(*size) + mu)
+def back_normal(size, mu=2, sigma=1, random=None):
+    return abs(sigma * (random or np.random).randn(*size) + mu)
 
 BACKGROUND_NORMAL = Background(partial(back_normal, mu=4, sigma=3), (400, 400), False)
 #########################
@@ -63,6 +68,21 @@ def step_function(x, step_x = 100, value=1000):
 def sine_intensity(x, freq=10, value=1000):
     omega = 2 * np.pi / freq
     return (0.5 * np.cos(omega * x) + 0.5) * value
+
+def random_iv_curve(energies, random, value=1000, peaks_per_100eV=4, width=(3, 10), floor=0.1):
+    """ Returns an intensity function resembling a LEED I(E)-curve: a sum of
+    Lorentzian peaks at random energies on a constant floor (fraction of value).
+
+    Deterministic for a given RandomState random.
+    """
+    e_min, e_max = min(energies), max(energies)
+    n_peaks = max(1, int(round(peaks_per_100eV * (e_max - e_min + 1) / 100.0)))
+    centers = random.uniform(e_min - 10, e_max + 10, n_peaks)
+    widths = random.uniform(width[0], width[1], n_peaks)
+    heights = random.uniform(0.2, 1.0, n_peaks)
+    def intensity(energy):
+        return value * (floor + np.sum(heights / (1 + ((energy - centers) / widths)**2)))
+    return intensity
 #########################
 
 #### energy_funcs ####
@@ -71,10 +91,22 @@ def linear(x, m=1.0, b=0.0):
 #######################
 
 def draw_gauss(x_spot, y_spot, sigma, npimage , integral = 1, multiplicator = None, sigma_cutoff = 4):
-    """ Draw an gaussian spot at x_spot, y_spot with width sigma and integral intensity."""
+    """ Draw an gaussian spot at x_spot, y_spot with width sigma and integral intensity.
+
+    Only the window up to sigma_cutoff * sigma around the spot is touched.
+    """
     if multiplicator is None:
         multiplicator = integral / (2 * sigma**2 * np.pi)
-    npimage += gaussian2d_rot(multiplicator, x_spot, y_spot, sigma)(*np.indices(npimage.shape))
+    half = int(np.ceil(sigma_cutoff * sigma))
+    x_int, y_int = int(round(x_spot)), int(round(y_spot))
+    y_lo, y_hi = max(y_int - half, 0), min(y_int + half + 1, npimage.shape[0])
+    x_lo, x_hi = max(x_int - half, 0), min(x_int + half + 1, npimage.shape[1])
+    if y_lo >= y_hi or x_lo >= x_hi:
+        return
+    # the gaussian is separable: outer product of the profiles in y and x
+    profile_y = np.exp(-(np.arange(y_lo, y_hi) - y_spot)**2 / (2 * sigma**2))
+    profile_x = np.exp(-(np.arange(x_lo, x_hi) - x_spot)**2 / (2 * sigma**2))
+    npimage[y_lo:y_hi, x_lo:x_hi] += multiplicator * np.outer(profile_y, profile_x)
 
 class Spot:
     def __init__(self, start_point, end_point, energy, intensity_func=constant_factory(1000), size=3, variable_size=False, energy_func=float):
@@ -110,22 +142,69 @@ class Spot:
             self.sigma = self.c_size / energy
         draw_gauss(x_spot, y_spot, self.sigma, npimage, integral=self.intensity_func(energy))
 
+def lattice_spots(size, n_spots, energies, random, sigma=2, radius=None, center=None,
+                  intensity_func=None):
+    """ Returns n_spots Spots on a jittered square grid filling an image of
+    the given size at the lowest energy, converging towards center as 1/sqrt(E).
+
+    radius: space kept free at the image borders (default: 3 * sigma)
+    intensity_func: factory (energies, random) -> intensity function per spot
+                    (default: random_iv_curve)
+    """
+    if center is None:
+        center = (size / 2, size / 2)
+    if radius is None:
+        radius = 3 * sigma
+    if intensity_func is None:
+        intensity_func = lambda energies, random: random_iv_curve(energies, random)
+    margin = radius + 4 * sigma
+    per_row = int(np.ceil(n_spots**0.5))
+    spacing = (size - 2 * margin) / per_row
+    energy = min(energies)
+    spots = []
+    for index in range(n_spots):
+        row, column = divmod(index, per_row)
+        start = margin + spacing * (np.array([column, row]) + 0.5)
+        start += random.uniform(-0.2, 0.2, 2) * spacing
+        spots.append(Spot(start, center, energy, size=sigma,
+                          intensity_func=intensity_func(energies, random)))
+    return spots
+
 class ImageGenerator:
     """ Generate test images."""
     def __init__(self, inputDir = "",
                  background = Background(np.zeros, (500, 500), True),
                  energies=range(75, 125),
-                 spots = [Spot((30.0, 30.0), (200, 200), 75, constant_factory(1000))]):
+                 spots = [Spot((30.0, 30.0), (200, 200), 75, constant_factory(1000))],
+                 seed = None, noise = None, dtype = None):
         """ input dir only for compatibility with ImageLoader,
+
+        seed: seed of the random numbers (default: global numpy RNG)
+        noise: None or "poisson" (shot noise on the whole image)
+        dtype: type of the yielded images (e.g. np.uint16, default: float)
+
+        The images are generated lazily while iterating; with a seed every
+        iteration yields the same images.
         """
         self.energies = sorted(energies)
         self.spots = spots
         self.background = background
+        self.seed = seed
+        self.noise = noise
+        self.dtype = dtype
+    def __len__(self):
+        return len(self.energies)
     def __iter__(self):
+        random = None if self.seed is None else np.random.RandomState(self.seed)
         for energy in self.energies:
-            npimage = self.background()
+            npimage = self.background(random)
             for spot in self.spots:
                 spot.draw(npimage, energy)
+            if self.noise == "poisson":
+                npimage = (random or np.random).poisson(np.maximum(npimage, 0)).astype(float)
+            if self.dtype is not None:
+                info = np.iinfo(self.dtype) if np.dtype(self.dtype).kind in "iu" else np.finfo(self.dtype)
+                npimage = np.clip(npimage, info.min, info.max).astype(self.dtype)
             yield npimage, energy
 
 class TestTracking:
@@ -241,6 +320,53 @@ class TestTracking:
         self.yss.append(ys)
         self.intensitiess.append(intensities)
 
+    def count_lost(self, name, seeds=range(20), max_distance=2, bank=False):
+        """ Returns the number of seeded runs of the scenario name in which a
+        spot got farther than max_distance from its true position.
+
+        bank: track with a TrackerBank instead of a Tracker per spot
+        """
+        lost = 0
+        for seed in seeds:
+            imageGenerator = ImageGenerator(seed=seed, **self.kwarg_dict[name])
+            energy = imageGenerator.energies[0]
+            spots = imageGenerator.spots
+            x_in, y_in = zip(*[spot.compute_position(energy) for spot in spots])
+            if bank:
+                tracker = TrackerBank(x_in, y_in, [self.radii[name]] * len(spots), energy)
+            else:
+                trackers = [Tracker(x, y, self.radii[name], energy) for x, y in zip(x_in, y_in)]
+            distance = 0
+            for image in imageGenerator:
+                if bank:
+                    results = tracker.feed_image(image)
+                else:
+                    results = [tracker.feed_image(image) for tracker in trackers]
+                for (x, y, intensity, energy, radius), spot in zip(results, spots):
+                    x_true, y_true = spot.compute_position(image[1])
+                    distance = max(distance, np.hypot(x - x_true, y - y_true))
+            if distance > max_distance:
+                lost += 1
+        return lost
+
+    def rms_error(self, name, seeds=range(5)):
+        """ Returns the root mean square distance of the tracked spots from
+        their true positions in seeded runs of the scenario name. """
+        squares = []
+        for seed in seeds:
+            imageGenerator = ImageGenerator(seed=seed, **self.kwarg_dict[name])
+            energy = imageGenerator.energies[0]
+            trackers = []
+            for spot in imageGenerator.spots:
+                x, y = spot.compute_position(energy)
+                trackers.append((Tracker(x, y, self.radii[name], energy), spot))
+            for image in imageGenerator:
+                for tracker, spot in trackers:
+                    x, y, intensity, energy, radius = tracker.feed_image(image)
+                    x_true, y_true = spot.compute_position(image[1])
+                    squares.append((x - x_true)**2 + (y - y_true)**2)
+        return np.mean(squares)**0.5
+
     def print_error(self, index, round_=4):
         bias_pos = (compute_bias(self.xss[index])**2 + compute_bias(self.yss[index])**2)**0.5
         stddev_pos = (compute_stddev(self.xss[index])**2 + compute_stddev(self.yss[index])**2)**0.5
@@ -274,6 +400,366 @@ def print_bias_stddev(bias, stddev, prefix="", round_=4):
     print prefix + "bias %s, sigma %s" % (round(bias, round_), round(stddev, round_))
 ######################
 
+#### regression checks ####
+def check_guess_funcs(name="point_small", seeds=range(20)):
+    """ Checks that guess_from_Gaussian_fast loses a spot in no more seeded
+    runs than guess_from_Gaussian. """
+    tester = TestTracking()
+    saved = config.Tracking_guessFunc
+    lost = {}
+    try:
+        for func in ("guess_from_Gaussian", "guess_from_Gaussian_fast"):
+            config.Tracking_guessFunc = func
+            lost[func] = tester.count_lost(name, seeds)
+    finally:
+        config.Tracking_guessFunc = saved
+    print "%s lost in %d (fast: %d) of %d runs" % (name, lost["guess_from_Gaussian"],
+                                                   lost["guess_from_Gaussian_fast"], len(seeds))
+    assert lost["guess_from_Gaussian_fast"] <= lost["guess_from_Gaussian"]
+
+def check_centroid(names=("point_small", "minimal", "back_uniform"), seeds=range(5)):
+    """ Checks that guess_from_centroid tracks the spots about as accurately
+    as guess_from_Gaussian and loses them in no more seeded runs. """
+    tester = TestTracking()
+    saved = config.Tracking_guessFunc
+    try:
+        for name in names:
+            error, lost = {}, {}
+            for func in ("guess_from_Gaussian", "guess_from_centroid"):
+                config.Tracking_guessFunc = func
+                error[func] = tester.rms_error(name, seeds)
+                lost[func] = tester.count_lost(name, seeds)
+            print "%s position error %.3f (centroid: %.3f), lost in %d (centroid: %d) of %d runs" % (
+                    name, error["guess_from_Gaussian"], error["guess_from_centroid"],
+                    lost["guess_from_Gaussian"], lost["guess_from_centroid"], len(seeds))
+            assert error["guess_from_centroid"] <= 1.2 * error["guess_from_Gaussian"] + 0.005
+            assert lost["guess_from_centroid"] <= lost["guess_from_Gaussian"]
+    finally:
+        config.Tracking_guessFunc = saved
+
+def check_batch_fitting(name="point_small", seeds=range(20)):
+    """ Checks that a TrackerBank with batch fitting loses a spot in no more
+    seeded runs than Trackers with guess_from_Gaussian. """
+    tester = TestTracking()
+    saved = config.Tracking_guessFunc, config.Tracking_batchFittingOn
+    try:
+        config.Tracking_guessFunc, config.Tracking_batchFittingOn = "guess_from_Gaussian", False
+        reference = tester.count_lost(name, seeds)
+        config.Tracking_batchFittingOn = True
+        lost = tester.count_lost(name, seeds, bank=True)
+    finally:
+        config.Tracking_guessFunc, config.Tracking_batchFittingOn = saved
+    print "%s lost in %d (batch: %d) of %d runs" % (name, reference, lost, len(seeds))
+    assert lost <= reference
+
+def check_kalman_bank(n_spots=10, n_steps=30, seed=0):
+    """ Checks that a PVKalmanFilterBank gives the states, covariances and
+    measurement distances of one PVKalmanFilter0-3 per spot. """
+    classes = [PVKalmanFilter0, PVKalmanFilter1, PVKalmanFilter2, PVKalmanFilter3]
+    for order, cls in enumerate(classes):
+        random = np.random.RandomState(seed)
+        x_in, y_in = random.uniform(0, 400, (2, n_spots))
+        P = np.diag([1, 1, 1000, 1000])
+        Q = np.diag([0.04, 0.04, 0, 0])
+        bank = PVKalmanFilterBank(x_in, y_in, P, 60, order=order)
+        filters = [cls(x, y, P, 60) for x, y in zip(x_in, y_in)]
+        for energy in range(61, 61 + n_steps):
+            bank.predict(energy, Q)
+            for kf in filters:
+                kf.predict(energy, Q)
+            z = bank.predict_measurement() + random.normal(0, 1, (n_spots, 2))
+            R = np.empty((n_spots, 2, 2))
+            R[:] = np.diag(random.uniform(0.1, 2, 2))
+            mask = random.uniform(size=n_spots) < 0.8
+            distances = bank.measurement_distance(z, R)
+            bank.update(z, R, mask)
+            for i, kf in enumerate(filters):
+                assert np.allclose(float(kf.measurement_distance(z[i], R[i])), distances[i])
+                if mask[i]:
+                    kf.update(z[i], R[i])
+        assert np.allclose(bank.x, [np.asarray(kf.x).ravel() for kf in filters])
+        assert np.allclose(bank.P, [np.asarray(kf.P) for kf in filters])
+    print "Kalman filter bank equal to %d single filters (orders 0-3)" % n_spots
+
+def check_batch_fitter(n_spots=16, n_energies=10, seed=0):
+    """ Checks that guesser_batch gives the positions, covariances, fitted
+    shapes and failure status of guesser with guess_from_Gaussian_fast
+    (with the fitted shapes of the last energy as hints). """
+    random = np.random.RandomState(seed)
+    energies = range(60, 60 + n_energies)
+    spots = lattice_spots(200, n_spots, energies, random, sigma=2, radius=6,
+            intensity_func=lambda energies, random: random_iv_curve(energies, random, 10000))
+    imageGenerator = ImageGenerator(energies=energies, spots=spots, seed=seed, noise="poisson",
+            background=Background(partial(back_uniform, level=4), (200, 200), True))
+    radius = np.ones(n_spots) * 6
+    hints = [{} for spot in spots]
+    compared = 0
+    for npimage, energy in imageGenerator:
+        # windows displaced as by a prediction, some outside the image
+        x, y = (np.array([spot.compute_position(energy) for spot in spots]) +
+                random.uniform(-1.5, 1.5, (n_spots, 2))).T
+        x[0] = -20
+        status = np.zeros(n_spots, dtype=np.uint8)
+        fits = [{} for spot in spots]
+        results = guesser_batch(npimage, x, y, radius, hints=hints, status=status, fits=fits)
+        for i in range(n_spots):
+            outcome, fit = {}, {}
+            result = guesser(npimage, x[i], y[i], radius[i], func=guess_from_Gaussian_fast,
+                             hint=hints[i], fit=fit, outcome=outcome)
+            assert (result is None) == (results[i] is None)
+            if result is None:
+                assert outcome["status"] == status[i]
+                continue
+            assert np.allclose(result[:2], results[i][:2], atol=1e-4)
+            assert np.allclose(result[2], results[i][2], rtol=1e-3)
+            assert np.allclose([fit[name] for name in HINT_NAMES],
+                               [fits[i][name] for name in HINT_NAMES], rtol=1e-3)
+            compared += 1
+        hints = fits
+    print "batch fits equal to %d single fits" % compared
+
+def check_checkpoint(n_spots=16, n_energies=20, seed=0):
+    """ Checks that a tracking resumed from a checkpoint after half of the
+    images gives the same results as an uninterrupted one (with batch
+    fitting, whose hints are part of the state, with and without the
+    lattice model). """
+    import os
+    import tempfile
+    from batch import TrackingEngine, config_values, save_checkpoint, load_checkpoint
+    saved = config_values()
+    handle, filename = tempfile.mkstemp(suffix=".ckpt")
+    os.close(handle)
+    try:
+        for lattice in (False, True):
+            config.Tracking_batchFittingOn = True
+            config.Tracking_latticeOn = lattice
+            random = np.random.RandomState(seed)
+            energies = range(60, 60 + n_energies)
+            spots = lattice_spots(300, n_spots, energies, random, sigma=2, radius=6,
+                    intensity_func=lambda energies, random: random_iv_curve(energies, random, 10000))
+            images = list(ImageGenerator(energies=energies, spots=spots, seed=seed, noise="poisson",
+                    background=Background(partial(back_uniform, level=4), (300, 300), True)))
+            start = [spot.compute_position(energies[0]) + (6,) for spot in spots]
+            engine = TrackingEngine(start, energies[0], n_energies)
+            engine.run(images)
+            reference = engine.results
+
+            engine = TrackingEngine(start, energies[0], n_energies)
+            engine.run(images[:n_energies // 2])
+            save_checkpoint(filename, engine)
+            config.Tracking_batchFittingOn = config.Tracking_latticeOn = None
+            state, spots_in, energy, arguments = load_checkpoint(filename)
+            engine = TrackingEngine(spots_in, energy, n_energies)
+            engine.set_state(state)
+            engine.run(images[n_energies // 2:])
+            for name in ("x", "y", "intensity", "radius", "status"):
+                assert np.array_equal(getattr(engine.results, name), getattr(reference, name))
+            assert np.array_equal(engine.results.energy, reference.energy)
+    finally:
+        os.remove(filename)
+        for name, value in saved.iteritems():
+            setattr(config, name, value)
+    print "resumed tracking equal to the uninterrupted one"
+
+class ListLoader:
+    """ Minimal image loader over a list of (npimage, energy) tuples. """
+    def __init__(self, images):
+        self.images = images
+        self.energies = [energy for npimage, energy in images]
+        self.restart()
+    def restart(self):
+        self.index = -1
+    def __iter__(self):
+        return self
+    def next(self):
+        if self.index + 1 >= len(self.images):
+            raise StopIteration
+        self.index += 1
+        return self.images[self.index]
+
+def check_cube(n_energies=5, seed=0):
+    """ Checks that the images of a series written by write_cube are read
+    back unchanged by CubeImageLoader (memory-mapped, compressed and
+    chunked cubes, whole images and windows). """
+    import os
+    import tempfile
+    from io import CubeImageLoader, write_cube, formats_available
+    if "HDF5" not in formats_available:
+        print "h5py not available, image cube not checked"
+        return
+    random = np.random.RandomState(seed)
+    energies = range(60, 60 + n_energies)
+    spots = lattice_spots(100, 4, energies, random, sigma=2, radius=6)
+    images = list(ImageGenerator(energies=energies, spots=spots, seed=seed, noise="poisson",
+            background=Background(partial(back_uniform, level=4), (80, 100), True), dtype=np.uint16))
+    handle, filename = tempfile.mkstemp(suffix=".h5")
+    os.close(handle)
+    try:
+        for compression, chunks in ((None, None), ("gzip", None), (None, (16, 32))):
+            write_cube(ListLoader(images), filename, compression, chunks)
+            loader = CubeImageLoader(filename)
+            try:
+                assert loader.energies == energies
+                read = list(loader)
+                assert len(read) == len(images)
+                for (npimage, energy), (cube_image, cube_energy) in zip(images, read):
+                    assert cube_energy == energy
+                    assert cube_image.dtype == npimage.dtype
+                    assert np.array_equal(cube_image, npimage)
+                    assert np.array_equal(loader.get_window(energy, slice(10, 30), slice(40, 90)),
+                                          npimage[10:30, 40:90])
+            finally:
+                loader.close()
+    finally:
+        os.remove(filename)
+    print "image cubes equal to the written images"
+
+def write_img(filename, npimage, energy):
+    """ Writes an image as .img file (HotLeed format). """
+    lines = ["Beam Voltage (eV): %d" % energy, "x1: 0", "y1: 0",
+             "x2: %d" % (npimage.shape[1] - 1), "y2: %d" % (npimage.shape[0] - 1),
+             "Number of frames: 1"]
+    header = "\n".join(lines) + "\n"
+    length = len(header) + len("Header length: 0000\n")
+    with open(filename, "wb") as f:
+        f.write("Header length: %04d\n" % length + header)
+        f.write(npimage.astype(np.uint16).tostring())
+
+def check_image_cache(n_extra=50, seed=0):
+    """ Checks that the image cache holds memory mapped .img frames as
+    copies: a series with more frames than file descriptors are allowed
+    is read through a cache large enough for all of them. """
+    import os
+    import shutil
+    import tempfile
+    import resource
+    from io import ImgImageLoader, is_mapped
+    random = np.random.RandomState(seed)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = 128 if soft == resource.RLIM_INFINITY else min(soft, 128)
+    n_energies = limit + n_extra
+    directory = tempfile.mkdtemp()
+    memory_map = config.IO_memoryMap
+    config.IO_memoryMap = True
+    try:
+        images = {}
+        paths = []
+        for energy in range(1, n_energies + 1):
+            images[energy] = random.randint(0, 1000, (16, 16)).astype(np.uint16)
+            paths.append(os.path.join(directory, "frame%04d.img" % energy))
+            write_img(paths[-1], images[energy], energy)
+        loader = ImgImageLoader(paths, r"\d+", cache_size=2**20)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            read = 0
+            for npimage, energy in loader:
+                assert np.array_equal(npimage, images[energy])
+                read += 1
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        assert read == n_energies
+        assert len(loader.cache) == n_energies
+        assert not any(is_mapped(npimage) for npimage in loader.cache.itervalues())
+        assert loader.cache_bytes == sum(npimage.nbytes for npimage in images.itervalues())
+        loader.close()
+    finally:
+        config.IO_memoryMap = memory_map
+        shutil.rmtree(directory)
+    print "%d memory mapped frames cached with %d file descriptors" % (n_energies, limit)
+
+def check_reintegration(n_spots=9, n_energies=10, seed=0):
+    """ Checks that the reintegrate command uses the parameters stored in
+    the result file unless overridden, and stores the ones it used. """
+    import os
+    import shutil
+    import tempfile
+    from batch import main, config_values, save_spots
+    from io import ResultFile
+    saved = config_values()
+    directory = tempfile.mkdtemp()
+    try:
+        random = np.random.RandomState(seed)
+        energies = range(60, 60 + n_energies)
+        spots = lattice_spots(200, n_spots, energies, random, sigma=2, radius=6,
+                intensity_func=lambda energies, random: random_iv_curve(energies, random, 10000))
+        images = ImageGenerator(energies=energies, spots=spots, seed=seed, noise="poisson",
+                background=Background(partial(back_uniform, level=20), (200, 200), True))
+        for npimage, energy in images:
+            write_img(os.path.join(directory, "image%d.img" % energy), npimage, energy)
+        save_spots(os.path.join(directory, "spots.txt"),
+                   [spot.compute_position(energies[0]) + (6,) for spot in spots])
+        prefix = os.path.join(directory, "result")
+        config.Processing_backgroundSubstractionOn = False
+        main(["track", directory, "-s", os.path.join(directory, "spots.txt"), "-o", prefix,
+              "-j", "1", "--checkpoint-interval", "0"])
+        tracked = ResultFile(prefix + ".res")
+        config.Processing_backgroundSubstractionOn = True
+        for option, background in ((None, False), ("--background", True)):
+            argv = ["reintegrate", prefix + ".res", directory, "-o", prefix + "2", "-j", "1"]
+            main(argv + [option] if option else argv)
+            result = ResultFile(prefix + "2.res")
+            assert result.parameters["Processing_backgroundSubstractionOn"] == background
+            assert np.array_equal(result.x, tracked.x)
+            same = np.array_equal(result.intensity, tracked.intensity)
+            assert same == (not background)
+    finally:
+        shutil.rmtree(directory)
+        for name, value in saved.iteritems():
+            setattr(config, name, value)
+    print "reintegration with the stored parameters equal to the tracking"
+
+def full_image_intensity(npimage, x, y, radius, background_substraction=True):
+    """ Intensity of a spot calculated on the whole image (reference for
+    StencilIntegrator). """
+    distances = calc_distances(npimage.shape, x, y)
+    intensities = npimage[distances <= radius**2]
+    intensity, area = np.sum(intensities), len(intensities)
+    if background_substraction:
+        intensity -= np.mean(npimage[np.logical_and(distances >= radius**2,
+                                                    distances <= 2 * radius**2)]) * area
+    return intensity
+
+def check_integrator(n_spots=50, seed=0):
+    """ Checks the stencil integration against the full image calculation
+    (exact and binned) and StencilIntegrator.intensities against
+    StencilIntegrator.intensity, also for windows clipped at the border. """
+    random = np.random.RandomState(seed)
+    npimage = random.poisson(10, (120, 100)).astype(float)
+    x = random.uniform(-2, 102, n_spots)
+    y = random.uniform(-2, 122, n_spots)
+    radius = random.uniform(2, 10, n_spots)
+    binned = StencilIntegrator(bins=20, radius_bins=4)
+    for background_substraction in (True, False):
+        exact = exact_integrator.intensities(npimage, x, y, radius, background_substraction)
+        cached = binned.intensities(npimage, x, y, radius, background_substraction)
+        for i in range(n_spots):
+            reference = full_image_intensity(npimage, x[i], y[i], radius[i], background_substraction)
+            assert np.allclose(calc_intensity(npimage, x[i], y[i], radius[i], background_substraction),
+                               reference)
+            assert np.allclose(exact[i], reference)
+            assert np.allclose(cached[i], binned.intensity(npimage, x[i], y[i], radius[i],
+                                                           background_substraction))
+            # binned: exact at the bin center and the rounded radius
+            x_bin = np.floor(x[i]) + (np.floor((x[i] % 1) * 20) + 0.5) / 20
+            y_bin = np.floor(y[i]) + (np.floor((y[i] % 1) * 20) + 0.5) / 20
+            assert np.allclose(cached[i], full_image_intensity(npimage, x_bin, y_bin,
+                               round(radius[i] * 4) / 4, background_substraction))
+    print "stencil integration equal to the full image calculation for %d spots" % n_spots
+
+def regression():
+    """ Runs all regression checks. """
+    check_guess_funcs()
+    check_centroid()
+    check_batch_fitting()
+    check_kalman_bank()
+    check_batch_fitter()
+    check_checkpoint()
+    check_reintegration()
+    check_cube()
+    check_image_cache()
+    check_integrator()
+######################
+
 #### main methods ####
 def tracking(test=None):
     tester = TestTracking()
@@ -383,6 +869,9 @@ if __name__ == "__main__":
     elif sys.argv[1] == "kalman":
         kalman(sys.argv)
 
+    elif sys.argv[1] == "regression":
+        regression()
+
     elif sys.argv[1] == "identification":
         identification(sys.argv)
 
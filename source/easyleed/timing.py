@@ -0,0 +1,121 @@
+"""
+easyleed.timing
+---------------
+
+Lightweight timers for the stages of the processing.
+
+The stages (e.g. "load", "predict", "fit", "integrate") are timed with the
+module wide Timers instance::
+
+    with timers("fit"):
+        ...
+
+Durations are collected per stage until reset() is called (the tracking
+engines reset them at the start of every run), can be queried with
+statistics() and summary(), and are passed to an optional hook.
+
+"""
+
+import time
+import array
+import logging
+
+import numpy as np
+
+from . import config
+
+logger = logging.getLogger("leedbase")
+
+class _Timer(object):
+    """ Context manager adding the duration of its body to a stage. """
+    __slots__ = ("timers", "name", "start")
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timers.add(self.name, time.time() - self.start)
+        return False
+
+class _NullTimer(object):
+    """ Context manager doing nothing (timers switched off). """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+class Timers(object):
+    """ Collects the durations of named stages.
+
+    hook: called with (name, seconds) for every timed stage (optional)
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.hook = None
+
+    def __call__(self, name):
+        """ Returns a context manager timing its body as stage name
+        (does nothing if config.Processing_timersOn is off). """
+        if not config.Processing_timersOn:
+            return _null_timer
+        return _Timer(self, name)
+
+    def add(self, name, seconds):
+        """ Adds the duration of one execution of a stage. """
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = array.array("d")
+        samples.append(seconds)
+        if self.hook is not None:
+            self.hook(name, seconds)
+
+    def merge(self, samples):
+        """ Adds the durations collected by another Timers (e.g. its samples
+        sent from a worker process). """
+        for name, values in samples.iteritems():
+            self.samples.setdefault(name, array.array("d")).extend(values)
+
+    def reset(self):
+        self.samples = {}
+
+    def statistics(self, percentiles=(50, 90, 99)):
+        """ Returns a dictionary with count, total, mean, max and the
+        given percentiles (in seconds) for every stage. """
+        result = {}
+        for name, samples in self.samples.iteritems():
+            values = np.frombuffer(samples, dtype=float) if len(samples) else np.zeros(1)
+            stats = dict(count=len(samples), total=values.sum(),
+                         mean=values.mean(), max=values.max())
+            for p, value in zip(percentiles, np.percentile(values, percentiles)):
+                stats["p%d" % p] = value
+            result[name] = stats
+        return result
+
+    def summary(self):
+        """ Returns a table of the statistics, stages sorted by total time. """
+        statistics = self.statistics()
+        lines = ["%-12s %8s %10s %10s %10s %10s" % ("stage", "count", "total [s]",
+                                                    "mean [ms]", "p90 [ms]", "max [ms]")]
+        for name in sorted(statistics, key=lambda name: -statistics[name]["total"]):
+            stats = statistics[name]
+            lines.append("%-12s %8d %10.3f %10.3f %10.3f %10.3f" % (name, stats["count"],
+                         stats["total"], 1e3 * stats["mean"], 1e3 * stats["p90"],
+                         1e3 * stats["max"]))
+        return "\n".join(lines)
+
+    def log_summary(self, level=logging.INFO):
+        if self.samples:
+            logger.log(level, "timing summary\n" + self.summary())
+
+""" Timers used by all modules. """
+timers = Timers()
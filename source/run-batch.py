@@ -0,0 +1,4 @@
+#! /usr/bin/env python
+import easyleed.batch
+
+easyleed.batch.main()